@@ -2,24 +2,406 @@
 # TODO: Support install without my repo?
 from __future__ import print_function
 
+import base64
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
+import json
 import os
+import pipes
 import random
 import re
 import string
 import sys
+import tempfile
+import time
+
+from fabric.api import abort, env, execute, hide, parallel, runs_once, show, task
+
+import bench
+import boottime
+import disks
+import executor
+import facts
+import mirrors
+import offline
+import pkgcache
+import render
+import roles
+import tuning
+
+valid_gpus = ['auto', 'nvidia', 'nouveau', 'amd', 'intel', 'vbox', 'vmware', 'qxl', 'generic']
+gpu_packages = {
+    'nvidia': ['lib32-mesa', 'lib32-nvidia-libgl', 'nvidia-libgl', 'nvidia-dkms'],
+    'nouveau': ['lib32-mesa', 'xf86-video-nouveau'],
+    'amd': ['lib32-mesa', 'xf86-video-ati', 'mesa-libgl', 'lib32-mesa-libgl', 'mesa-vdpau', 'lib32-mesa-vdpau'],
+    'intel': ['lib32-mesa', 'xf86-video-intel'],
+    'vbox': ['virtualbox-guest-dkms', 'virtualbox-guest-utils'],
+    'vmware': ['open-vm-tools', 'xf86-input-vmmouse', 'xf86-video-vmware'],
+    'qxl': ['lib32-mesa', 'spice-vdagent', 'xf86-video-qxl'],
+    # Any other GPU, driven by the kernel's modesetting driver
+    'generic': ['lib32-mesa'],
+}
+gpu_services = {
+    'vbox': ['vboxservice'],
+    'vmware': ['vmtoolsd', 'vmware-vmblock-fuse'],
+}
+dray_repo_package = 'https://repo.dray.be/dray-repo-latest'
+# Font rendering packages installed with a GUI, from their own repositories
+infinality_key = '962DDE58'
+infinality_packages = [
+    'freetype2-infinality-ultimate', 'cairo-infinality-ultimate', 'fontconfig-infinality-ultimate',
+    'ibfonts-meta-extended', 'ttf-noto-fonts-emoji-ib']
+# btrfs mount options of the root filesystem for each fs_profile. They are
+# used from the first mount on, so pacstrap already writes compressed files
+fs_profiles = {
+    'default': ['relatime'],
+    'throughput': ['noatime', 'compress=zstd:1', 'space_cache=v2'],
+    'ssd': ['noatime', 'compress=zstd:3', 'ssd', 'discard=async', 'space_cache=v2'],
+    'vm': ['noatime', 'compress=zstd:1', 'discard=async', 'space_cache=v2'],
+}
+
+# Subvolumes split out of root by every fs_profile except default, as
+# (subvolume, mountpoint, nodatacow). Packages are compressed already and
+# written once, so the package cache gains nothing from copy-on-write
+fs_subvolumes = [
+    ('pkg', '/var/cache/pacman/pkg', True),
+    ('log', '/var/log', False),
+    ('home', '/home', False),
+]
+
+# pacman hooks that rebuild the initramfs whenever a kernel or mkinitcpio is
+# installed. They are masked for the install, which builds it once at the end
+initramfs_hooks = ['90-mkinitcpio-install.hook', '90-linux.hook']
+mkinitcpio_install = '/usr/share/libalpm/scripts/mkinitcpio-install'
+
+# Kernel module each GPU needs loaded early from the initramfs
+gpu_modules = {'nouveau': 'nouveau', 'amd': 'radeon', 'intel': 'i915', 'vbox': 'vboxvideo', 'vmware': 'vmhgfs',
+               'qxl': 'qxl'}
+
+# Downloads packages in the background while the install runs. Packages are
+# resolved against an empty local database so that the full dependency
+# closure is fetched, and each one is checked and retried on its own. Each
+# stage file holds package names, and the stages file each stage with the
+# cache it is fetched into; <stage>.done is created when it finishes and
+# <stage>.failed lists the urls that could not be fetched.
+prefetch_dir = '/var/tmp/fabulous-prefetch'
+prefetch_script = r'''#!/bin/bash
+state=$1 workers=$2
+db=$state/db
+mkdir -p "$db/local"
+cp -a /var/lib/pacman/sync "$db/"
+
+fetch() {
+    local url=$1 file=$cache/${1##*/} try
+    for try in 1 2 3; do
+        if [[ -f $file ]] && bsdtar -tf "$file" &>/dev/null; then
+            return 0
+        fi
+        rm -f "$file"
+        curl -fsSL --retry 2 -o "$file.part" "$url" && mv "$file.part" "$file"
+    done
+    echo "$url" >> "$state/$stage.failed"
+    return 1
+}
+export -f fetch
+export state
+
+available=$(pacman --dbpath "$db" -Slq; pacman --dbpath "$db" -Sgq | sort -u)
+while read -r -u 3 stage cache; do
+    export stage cache
+    mkdir -p "$cache"
+    packages=$(grep -xFf <(echo "$available") "$state/$stage")
+    pacman --dbpath "$db" --noconfirm -Sp $packages | grep '://' |
+        xargs -P "$workers" -n 1 bash -c 'fetch "$0"'
+    touch "$state/$stage.done"
+done 3< "$state/stages"
+'''
+
+# The host's own pacman.conf while an install uses an offline bundle
+host_pacman_conf_backup = '/etc/pacman.conf.fabulous'
+
+# Phases completed on the target, used to resume a failed install
+state_file = '/var/lib/fabulous/completed-phases'
+
+# Most output of a pacman run Fabric keeps in memory. Progress is parsed
+# from the stream as it arrives, so the result is only needed for its tail
+pacman_output_buffer = 1 << 16
+
+# Phases that configure a single machine. Everything else is common to
+# every install and can come from a base image made by build_image
+host_phases = ['host identity', 'tuning', 'users', 'network', 'boot', 'boot loader']
+
+# What each phase reads and writes in the target, as (reads, writes).
+# run_phases() runs phases that share nothing they write at the same time.
+# Phases missing from here conflict with every other phase.
+phase_resources = {
+    'mdns': ([], ['nsswitch.conf']),
+    'services': ([], ['units']),
+    'cron': ([], ['cron']),
+    'locale': ([], ['locale']),
+    'timezone': ([], ['packages', 'localtime']),
+    'gui': ([], ['packages', 'passwd', 'pacman.conf', 'units', 'cron', 'plymouth']),
+    'settings': ([], ['journald.conf', 'pam', 'udev rules']),
+    'extra packages': ([], ['packages', 'passwd']),
+    'sudo': ([], ['sudoers']),
+    'host identity': ([], ['machine-id', 'ssh host keys', 'packages']),
+    'tuning': ([], ['packages', 'sysctl', 'udev rules', 'zram', 'units']),
+    'users': (['sudoers'], ['passwd']),
+    'network': ([], ['hostname', 'hosts', 'fstab']),
+    'boot': ([], ['units', 'initramfs']),
+}
+
+# Runs the jobs of run_concurrent() inside the chroot. Each directory under
+# $1 holds the command files of one job, which run in order as in
+# flush_chroot(), while the jobs run side by side with their own logs.
+chroot_jobs_script = r'''cd "$1"
+for job in */; do
+    job=${job%/}
+    (
+        start=$(date +%s%N)
+        rc=0
+        for f in $job/*; do
+            echo "chroot-batch: start ${f##*/}"
+            bash $f || { rc=$?; echo "chroot-batch: failed ${f##*/}"; break; }
+        done
+        echo "$rc $(( ($(date +%s%N) - start) / 1000000 ))" > $job.rc
+    ) > $job.log 2>&1 < /dev/null &
+done
+wait
+status=0
+for job in */; do
+    job=${job%/}
+    read rc ms < $job.rc
+    echo "chroot-job: begin $job"
+    cat $job.log
+    echo "chroot-job: end $job $rc $ms"
+    if [ $rc -ne 0 ] && [ $status -eq 0 ]; then
+        status=$rc
+    fi
+done
+if [ $status -eq 0 ]; then
+    rm -rf "$1"
+fi
+exit $status
+'''
+
+# InstallContext of the install running against each host
+_contexts = {}
+
 
-from fabric.api import env, hide, put, sudo, task
+class InstallContext(object):
+    """
+    State of a single install_os run against one host. Kept out of env so
+    that several hosts can be installed at once.
+    """
 
-valid_gpus = ['auto', 'nvidia', 'nouveau', 'amd', 'intel', 'vbox', 'vmware']
-base_packages = [
-    'avahi', 'bind-tools', 'btrfs-progs', 'cronie', 'dkms',
-    'git', 'gptfdisk', 'haveged', 'linux-headers', 'networkmanager', 'nfs-utils', 'nss-mdns',
-    'ntp', 'pacaur', 'pkgfile', 'pkgstats', 'openssh', 'rsync', 'sudo', 'tzupdate', 'vim', 'zsh']
-base_services = ['avahi-daemon', 'cronie', 'haveged', 'NetworkManager', 'nscd', 'ntpd', 'sshd']
-gui_packages = [
-    'aspell-en', 'file-roller', 'gdm-plymouth', 'gnome', 'gnome-packagekit', 'gnome-tweak-tool', 'gst-libav', 'gst-plugins-ugly', 'terminator']
-gui_services = ['gdm']
+    def __init__(self, host):
+        self.host = host
+        self.dest = None
+        # Disks of a device install, the first holding boot
+        self.device = None
+        self.devices = []
+        # Name of the disk holding the target and whether it is rotational,
+        # or an empty name if it was not found
+        self.disk = ('', None)
+        # Commands queued by chroot() while inside a chroot_batch() block
+        self.chroot_queue = None
+        # Contents of the files written by write_file() not yet uploaded,
+        # by their name in render.staging_dir
+        self.files = {}
+        self.file_count = 0
+        self.phases = []
+        # Phases recorded as done in the target's state file
+        self.completed = set()
+        self.start = time.time()
+        self.trace = []
+        self.log_path = None
+        self.trace_path = None
+        # Commands recorded for a compiled install instead of being run
+        self.script = None
+        # Base image made by build_image to install from
+        self.image = None
+        self.package_cache = False
+        self.cache_port = None
+        # Ranked or given mirrors written to the mirrorlists, best first
+        self.mirrors = []
+        self.parallel_downloads = 5
+        # Packages installed by the consolidated transaction
+        self.installed = set()
+        # Prefetch stages not yet waited for
+        self.prefetch = []
+        self.prefetch_workers = 4
+        # Name of the phase running, for progress output
+        self.current_phase = None
+        # Run independent phases at the same time
+        self.concurrent = True
+        self.fs_profile = 'default'
+        # Resolved role profile, whose packages and services are installed
+        self.role = None
+        # Hardware facts of the host, collected by collect_facts()
+        self.facts = None
+        # Chosen by tuning.tune() from the detected hardware
+        self.tuning = None
+        self.tuning_profile = 'auto'
+        self.tuning_overrides = None
+        # Chosen by boottime.plan() when fast_boot or boot_report is set
+        self.fast_boot = False
+        self.boot_report = False
+        self.boot = None
+        # Where the offline bundle is unpacked on the host, when installing
+        # from one
+        self.bundle = None
+        # Passwords set by the install, kept out of its log and trace
+        self.secrets = []
+
+    def summary(self):
+        return {'host': self.host, 'phases': list(self.phases),
+                'trace': self.trace_path, 'tuning': self.tuning}
+
+    def open_log(self, log_dir, name):
+        """
+        Write log messages to a file in log_dir and the trace of the install
+        next to it when the install finishes.
+        """
+        log_dir = os.path.expanduser(log_dir)
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        base = os.path.join(log_dir, '{0}-{1}'.format(
+            name, datetime.now().strftime('%Y%m%d-%H%M%S')))
+        self.log_path = base + '.log'
+        self.trace_path = base + '.trace.json'
+
+    def write_trace(self):
+        """Save the trace in Chrome's trace event format (chrome://tracing)."""
+        if not self.trace_path:
+            return
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': 1,
+                   'args': {'name': self.host}}] + self.trace
+        with open(self.trace_path, 'w') as f:
+            f.write(self.redact(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                                           indent=1)))
+
+    def redact(self, text):
+        """Return text with the install's secrets masked, as is or JSON escaped."""
+        for secret in self.secrets:
+            for form in (secret, json.dumps(secret)[1:-1]):
+                text = text.replace(form, '********')
+        return text
+
+
+def context():
+    """Return the InstallContext of the install running on the current host."""
+    return _contexts[env.host_string]
+
+
+def redact(text):
+    """Return text with the secrets of the current host's install masked."""
+    ctx = _contexts.get(env.host_string)
+    return ctx.redact(text) if ctx else text
+
+
+def new_context():
+    ctx = InstallContext(env.host_string)
+    _contexts[env.host_string] = ctx
+    return ctx
+
+
+@contextmanager
+def traced(name, category, **args):
+    """
+    Record the block as an event in the install trace. The yielded dict is
+    stored as the event arguments, for exit codes and byte counts.
+    """
+    ctx = _contexts.get(env.host_string)
+    start = time.time()
+    try:
+        yield args
+    finally:
+        if ctx and ctx.script is None:
+            ctx.trace.append({
+                'name': name, 'cat': category, 'ph': 'X', 'pid': 1, 'tid': 1,
+                'ts': int((start - ctx.start) * 1e6),
+                'dur': int((time.time() - start) * 1e6),
+                'args': args})
+
+
+class CompiledResult(str):
+    """
+    Result of a command recorded into a compiled install script. The
+    command has not run yet, so it is assumed to succeed.
+    """
+    return_code = 0
+    succeeded = True
+    failed = False
+    stderr = ''
+
+
+def sudo(command, **kwargs):
+    """
+    Run command through the current executor, which is Fabric's sudo unless
+    the install is being recorded or simulated, and record it in the install
+    trace. While an install is being compiled the command is appended to its
+    script instead.
+    """
+    ctx = _contexts.get(env.host_string)
+    if ctx and ctx.script is not None:
+        tolerate = kwargs.get('quiet') or kwargs.get('warn_only')
+        ctx.script.append(('run', command, bool(tolerate)))
+        return CompiledResult()
+    with traced(command.strip().split('\n')[0][:80], 'sudo') as args:
+        args['exit_code'] = None
+        result = executor.current().sudo(command, **kwargs)
+        args['exit_code'] = result.return_code
+        args['bytes_sent'] = len(command)
+        args['bytes_received'] = len(result) + len(result.stderr)
+    return result
+
+
+def put(local_path, remote_path, **kwargs):
+    """
+    Upload a file through the current executor, recorded in the install
+    trace. While an install is being compiled the file is embedded in its
+    script instead.
+    """
+    ctx = _contexts.get(env.host_string)
+    if ctx and ctx.script is not None:
+        with open(os.path.expanduser(local_path), 'rb') as f:
+            data = base64.b64encode(f.read())
+        command = "base64 -d > '{0}' <<'FABULOUS_FILE'\n{1}\nFABULOUS_FILE".format(remote_path, data)
+        if kwargs.get('mode'):
+            command += "\nchmod %o '%s'" % (kwargs['mode'], remote_path)
+        return sudo(command)
+    with traced('put %s' % remote_path, 'put', local_path=local_path) as args:
+        args['bytes_sent'] = os.path.getsize(os.path.expanduser(local_path))
+        return executor.current().put(local_path, remote_path, **kwargs)
+
+
+def probe(commands):
+    """
+    Run several short commands in a single round trip. commands maps names
+    to commands, and the result maps the same names to the results of the
+    commands, with their output and return code like sudo()'s.
+    """
+    script = ''.join("""(
+{1}
+) 2>&1; printf '\\n@@probe {0} %d\\n' $?
+""".format(name, command) for name, command in sorted(commands.items()))
+    out = sudo(script, quiet=True)
+    parts = re.split(r'\r?\n@@probe (\S+) (\d+)\r?(?:\n|$)', '\n' + out)
+    results = dict((name, executor.Result('', 1)) for name in commands)
+    for index in range(0, len(parts) - 2, 3):
+        results[parts[index + 1]] = executor.Result(parts[index].strip(), int(parts[index + 2]))
+    return results
+
+
+def connect():
+    """
+    Open the connection to the current host that every command of the
+    install shares, and record how long it took in the trace.
+    """
+    with traced('connect %s' % env.host_string, 'connection') as args:
+        args['seconds'] = executor.current().connect()
 
 
 def generate_password(length):
@@ -30,147 +412,344 @@ def generate_password(length):
 
 def pacman(packages, pacstrap=False, remote=False):
     """
-    Accepts a list of packages to be installed to env.dest via pacman
-    in the chroot. Requires a base install to have been completed, but
-    caches to disk instead of tmpfs.
+    Accepts a list of packages to be installed to the target, with pacstrap
+    for the base install and pacman in the chroot after it. Requires a base
+    install to have been completed, but caches to disk instead of tmpfs.
     """
     if remote:
         remote = ''
     else:
         remote = '-c'
-    script_name = '/var/tmp/pacman.sh'
-    command = 'pacman -Sy --noconfirm --force'
+    ctx = context()
+    if not pacstrap and set(packages) <= ctx.installed:
+        # Already installed with the rest of the install's packages
+        return
+    wait_for_prefetch('base' if pacstrap else 'all')
     if pacstrap:
-        command = 'pacstrap %s %s' % (remote, env.dest)
-    script = """#!/bin/bash
-count=0
-while [[ $count -lt 5 ]]
-do
-    {0} {1} 2>&1| tee /tmp/out
-    rc=$?
-    if grep 'invalid or corrupted package' /tmp/out; then
-        count=$((count+1))
-        echo "Failed $count times!"
-    elif grep 'Failed to install packages' /tmp/out; then
-        echo "Fatal error encountered!"
-        break
-    else
-        exit 0
-    fi
-done
-exit 1
-EOF""".format(command, ' '.join(packages))
-    path = '' if pacstrap else env.dest
-    sudo("cat <<-'EOF' > %s%s\n" % (path, script_name) + script)
-    sudo('chmod +x %s/%s' % (path, script_name), quiet=True)
-    return sudo(script_name) if pacstrap else chroot(script_name)
+        command = 'pacstrap %s %s %s' % (remote, ctx.dest, ' '.join(packages))
+    elif ctx.bundle:
+        # The bundle is only reachable from the host, so packages are
+        # installed from there into the target, leaving its keyring and
+        # mirrorlist alone. They are copied to the target's cache, as the
+        # host's may well be in memory
+        command = "pacstrap -G -M %s --overwrite '*' %s" % (ctx.dest, ' '.join(packages))
+    else:
+        command = "arch-chroot %s pacman -Sy --noconfirm --overwrite '*' %s" % (
+            ctx.dest, ' '.join(packages))
+    flush_chroot()
+    with traced(' '.join(packages)[:80], 'pacman', packages=packages,
+                pacstrap=pacstrap) as args:
+        if ctx.script is not None:
+            # There is no output to watch until the compiled install runs
+            out = sudo('for attempt in 1 2 3 4 5; do %s && exit 0; done; exit 1' % command)
+        else:
+            out = run_pacman(command, ctx.current_phase or 'pacman')
+        args['exit_code'] = out.return_code
+    return out
+
+
+def run_pacman(command, label):
+    """
+    Run a pacman or pacstrap command, showing its progress as it goes, and
+    run it again, up to 5 times in all, while it fails on corrupted packages.
+    pacman deletes those from the cache, so they are downloaded again.
+    """
+    for attempt in range(1, 6):
+        stream = PacmanProgress(label)
+        with show('stdout'):
+            out = sudo(command, stdout=stream, warn_only=True,
+                       capture_buffer_size=pacman_output_buffer)
+        stream.close()
+        if out.succeeded:
+            return out
+        # pacstrap reports every failure of pacman as fatal, corrupted
+        # packages included, so those are retried whatever else was said
+        if not stream.corrupted:
+            break
+        if attempt < 5:
+            log('Downloading %d corrupted packages again (attempt %d of 5)...' % (
+                len(stream.corrupted), attempt + 1))
+    abort('pacman failed with exit code {0}: {1}\n{2}'.format(
+        out.return_code, command, '\n'.join(stream.lines)))
 
 
 def chroot(command, warn_only=False, quiet=False, user=None):
+    """
+    Run command inside the target with arch-chroot. Inside a chroot_batch()
+    block the command is queued instead, unless its result is needed
+    (quiet or warn_only), in which case the queue is flushed first and the
+    command is run straight away.
+    """
+    ctx = context()
     sudo_cmd = ''
     if user:
         sudo_cmd = 'sudo -u %s' % user
-    sudo("""cat <<CHROOTEOF > {0}/var/tmp/chroot-cmd
+    if ctx.chroot_queue is not None:
+        if not quiet and not warn_only:
+            ctx.chroot_queue.append('%s %s' % (sudo_cmd, command))
+            return
+        flush_chroot()
+    with traced(command.strip().split('\n')[0][:80], 'chroot'):
+        sudo("""{3}cat <<CHROOTEOF > {0}/var/tmp/chroot-cmd
 #!/bin/bash -ex
 {1} {2}
 CHROOTEOF
-""".format(env.dest, sudo_cmd, command))
-    return sudo("""arch-chroot {0} bash -c 'bash /var/tmp/chroot-cmd && rm /var/tmp/chroot-cmd'""".format(env.dest, command), quiet=quiet, warn_only=warn_only)
+""".format(ctx.dest, sudo_cmd, command, upload_files()))
+        return sudo("""arch-chroot {0} bash -c 'bash /var/tmp/chroot-cmd && rm /var/tmp/chroot-cmd'""".format(ctx.dest, command), quiet=quiet, warn_only=warn_only)
+
+
+@contextmanager
+def chroot_batch():
+    """
+    Queue the chroot() calls made in this block and run them in a single
+    arch-chroot session on exit. Nested blocks join the outer batch.
+    """
+    ctx = context()
+    if ctx.chroot_queue is not None:
+        yield
+        return
+    ctx.chroot_queue = []
+    try:
+        yield
+        flush_chroot()
+    finally:
+        ctx.chroot_queue = None
+
+
+@contextmanager
+def phase(name):
+    """
+    Time a named step of the install for the run summary. chroot() calls
+    made inside it are batched into a single session.
+    """
+    ctx = context()
+    ctx.current_phase = name
+    if ctx.script is not None:
+        ctx.script.append(('event', 'phase-start %s' % name, False))
+        with chroot_batch():
+            yield
+        ctx.script.append(('event', 'phase-end %s' % name, False))
+        return
+    start = time.time()
+    try:
+        with traced(name, 'phase'):
+            with chroot_batch():
+                yield
+    finally:
+        ctx.phases.append((name, time.time() - start))
+
+
+def flush_chroot():
+    """
+    Run the commands queued by chroot_batch() as one script. Each command
+    keeps its own bash -ex file so that the first failure is reported with
+    the command and output that caused it.
+    """
+    ctx = context()
+    if not ctx.chroot_queue:
+        return
+    commands, ctx.chroot_queue = ctx.chroot_queue, []
+    batch_dir = '/var/tmp/chroot-batch'
+    script = upload_files()
+    script += 'rm -rf {0}{1} && mkdir -p {0}{1}\n'.format(ctx.dest, batch_dir)
+    for index, command in enumerate(commands):
+        script += """cat <<CHROOTEOF > {0}{1}/{2:03d}
+#!/bin/bash -ex
+{3}
+CHROOTEOF
+""".format(ctx.dest, batch_dir, index, command)
+    with traced('%d batched commands' % len(commands), 'chroot', commands=commands):
+        sudo(script)
+        # A compiled install has to stop at a failing batch, so only warn
+        # when the output can be inspected here
+        out = sudo("""arch-chroot {0} bash -c 'for f in {1}/*; do echo "chroot-batch: start ${{f##*/}}"; bash $f || {{ rc=$?; echo "chroot-batch: failed ${{f##*/}}"; exit $rc; }}; done; rm -rf {1}'""".format(ctx.dest, batch_dir), warn_only=ctx.script is None)
+    if out.failed:
+        failed = re.search('^chroot-batch: failed (\d+)', out, re.MULTILINE)
+        if not failed:
+            abort('Batched chroot commands failed:\n%s' % out)
+        step = failed.group(1)
+        output = out.split('chroot-batch: start %s' % step)[-1]
+        output = output.split('chroot-batch: failed %s' % step)[0].strip()
+        abort(redact('chroot command failed with exit code {0}: {1}\n{2}'.format(
+            out.return_code, commands[int(step)].strip(), output)))
+
+
+def stage_file(content):
+    """
+    Add content to the files uploaded with the next chroot commands run, and
+    return its path in the target. Commands queued after this call can use
+    it.
+    """
+    ctx = context()
+    name = '%03d' % ctx.file_count
+    ctx.file_count += 1
+    ctx.files[name] = content
+    return '%s/%s' % (render.staging_dir, name)
+
+
+def upload_files():
+    """
+    Return the command unpacking the files staged since the last upload
+    into the target, to run on the host before the chroot commands using
+    them, or an empty string if there are none.
+    """
+    ctx = context()
+    if not ctx.files:
+        return ''
+    files, ctx.files = ctx.files, {}
+    return render.unpack_command(files, ctx.dest + render.staging_dir)
 
 
 def enable_multilib_repo(target):
-    cmd = sudo if target is 'host' else chroot
-    if not cmd("grep -q '^\[multilib\]' /etc/pacman.conf", quiet=True).succeeded:
-        cmd('echo [multilib] >> /etc/pacman.conf')
-        cmd('echo Include = /etc/pacman.d/mirrorlist >> /etc/pacman.conf')
+    cmd = sudo if target == 'host' else chroot
+    cmd("grep -q '^\[multilib\]' /etc/pacman.conf || "
+        "echo -e '[multilib]\\nInclude = /etc/pacman.d/mirrorlist' >> /etc/pacman.conf")
 
 
 def enable_dray_repo(target):
-    cmd = sudo if target is 'host' else chroot
-    cmd('curl -o /tmp/repo.pkg.tar.xz https://repo.dray.be/dray-repo-latest && '
-        'pacman -U --noconfirm /tmp/repo.pkg.tar.xz')
+    ctx = context()
+    if ctx.bundle:
+        if target == 'host':
+            # The host installs from the bundle alone
+            return
+        # arch-chroot mounts its own /tmp
+        sudo('cp {0}/dray-repo.pkg.tar.xz {1}/var/tmp/repo.pkg.tar.xz'.format(ctx.bundle, ctx.dest))
+        chroot('pacman -U --noconfirm /var/tmp/repo.pkg.tar.xz && rm /var/tmp/repo.pkg.tar.xz')
+        return
+    cmd = sudo if target == 'host' else chroot
+    cmd('curl -o /tmp/repo.pkg.tar.xz %s && '
+        'pacman -U --noconfirm /tmp/repo.pkg.tar.xz' % dray_repo_package)
+
+
+def enable_parallel_downloads(target, count):
+    cmd = sudo if target == 'host' else chroot
+    cmd("sed -i 's/^#\\?ParallelDownloads.*/ParallelDownloads = {0}/' /etc/pacman.conf && "
+        "(grep -q '^ParallelDownloads' /etc/pacman.conf || "
+        "sed -i '/^\\[options\\]/a ParallelDownloads = {0}' /etc/pacman.conf)".format(int(count)))
+
+
+def write_mirrorlist(target, urls):
+    content = mirrors.mirrorlist(urls)
+    if target == 'host':
+        sudo("cat <<'EOF' > /etc/pacman.d/mirrorlist\n%sEOF" % content)
+    else:
+        write_file('/etc/pacman.d/mirrorlist', content)
 
 
-def enable_mdns(target):
-    cmd = sudo if target is 'host' else chroot
-    cmd('pacman -Sy --noconfirm --needed avahi nss-mdns')
-    cmd("sed -i 's/^hosts.*/hosts: files mdns_minimal [NOTFOUND=return] dns myhostname/' /etc/nsswitch.conf")
-    cmd('nscd -i hosts', quiet=True)
+def select_mirrors(rank, candidates, count, ttl):
+    """
+    Return the count fastest of the candidate mirrors, or of the default
+    ones, as measured from this machine and cached for ttl seconds. Returns
+    an empty list when rank is off or no mirror answered.
+    """
+    if not rank:
+        return []
+    if isinstance(candidates, basestring):
+        candidates = candidates.split()
+    log('Ranking mirrors...')
+    ranking = mirrors.ranked(candidates, ttl)
+    if not ranking:
+        log('No mirror answered, keeping the mirrorlists as they are')
+    for result in ranking[:int(count)]:
+        log('  {url}: {latency:.2f}s latency, {rate:.1f} MiB/s'.format(
+            rate=result['throughput'] / 1048576.0, **result))
+    return [result['url'] for result in ranking[:int(count)]]
+
+
+def enable_package_cache(target, port):
+    """
+    Make the package cache proxy tunnelled to port the first mirror. The
+    entry is marked so that disable_package_cache() can remove it again.
+    """
+    cmd = sudo if target == 'host' else chroot
+    line = pkgcache.mirror_line(port)
+    if target != 'host':
+        # chroot() writes its commands through an unquoted heredoc
+        line = line.replace('$', '\\$')
+    cmd("grep -q '{0}' /etc/pacman.d/mirrorlist || sed -i '1i {1}' /etc/pacman.d/mirrorlist".format(
+        pkgcache.marker, line))
+
+
+def disable_package_cache(root=''):
+    sudo("sed -i '/%s$/d' %s/etc/pacman.d/mirrorlist" % (pkgcache.marker, root), quiet=True)
 
 
-def gpu_detect(gpu):
-    if gpu != 'auto':
-        return gpu
-    lspci = sudo('lspci|grep VGA').lower()
-    if 'intel' in lspci:
-        return 'intel'
-    if 'nvidia' in lspci:
-        return 'nvidia'
-    if 'amd' in lspci:
-        return 'amd'
-    if 'virtualbox' in lspci:
-        return 'vbox'
+@contextmanager
+def serve_package_cache(ctx, cache_dir, cache_size, mirror):
+    """
+    Serve the package cache proxy from this machine, unless it is already
+    running, and tunnel it to the same port on the host being installed. A
+    simulated install only goes through the motions on the host.
+    """
+    if not ctx.package_cache:
+        yield
+        return
+    started = False
+    if not executor.current().simulated:
+        started = pkgcache.start(cache_dir, cache_size, ctx.mirrors or [mirror], ctx.cache_port)
+    try:
+        with executor.current().tunnel(int(ctx.cache_port)):
+            try:
+                yield
+            finally:
+                disable_package_cache()
+                if ctx.dest:
+                    disable_package_cache(ctx.dest)
+    finally:
+        if started:
+            log('Package cache: %s' % pkgcache.format_stats(pkgcache.stop()))
+
+
+def enable_mdns(target):
+    cmd = sudo if target == 'host' else chroot
+    if target == 'host':
+        # Part of the base role in the chroot
+        sudo('pacman -Sy --noconfirm --needed avahi nss-mdns')
+    cmd("sed -i 's/^hosts.*/hosts: files mdns_minimal [NOTFOUND=return] dns myhostname/' /etc/nsswitch.conf")
+    if target == 'host':
+        # Nothing is running inside the chroot to invalidate
+        sudo('nscd -i hosts', quiet=True)
 
 
 def gpu_install(gpu):
-    gpu = gpu_detect(gpu)
     log('Found {0} GPU...'.format(gpu))
     log('Installing graphics drivers...')
 
-    if gpu == 'nvidia':
-        gpu_packages = ['lib32-mesa', 'lib32-nvidia-libgl', 'nvidia-libgl', 'nvidia-dkms']
-    if gpu == 'nouveau':
-        gpu_packages = ['lib32-mesa', 'xf86-video-nouveau']
-        chroot("""sed -i 's/MODULES="/MODULES="nouveau /' /etc/mkinitcpio.conf""")
-    if gpu == 'amd':
-        gpu_packages = ['lib32-mesa', 'xf86-video-ati', 'mesa-libgl', 'lib32-mesa-libgl', 'mesa-vdpau', 'lib32-mesa-vdpau']
-        chroot("""sed -i 's/MODULES="/MODULES="radeon /' /etc/mkinitcpio.conf""")
-    if gpu == 'intel':
-        gpu_packages = ['lib32-mesa', 'xf86-video-intel']
-        chroot("""sed -i 's/MODULES="/MODULES="i915 /' /etc/mkinitcpio.conf""")
     if gpu == 'vbox':
-        gpu_packages = ['virtualbox-guest-dkms', 'virtualbox-guest-utils']
-        chroot("""sed -i 's/MODULES="/MODULES="vboxvideo /' /etc/mkinitcpio.conf""")
-        chroot("echo -e 'vboxguest\nvboxsf\nvboxvideo' > /etc/modules-load.d/virtualbox.conf")
+        write_file('/etc/modules-load.d/virtualbox.conf', 'vboxguest\nvboxsf\nvboxvideo\n')
     if gpu == 'vmware':
-        gpu_packages = ['open-vm-tools', 'xf86-input-vmmouse', 'xf86-video-vmware']
-        chroot("""sed -i 's/MODULES="/MODULES="vmhgfs /' /etc/mkinitcpio.conf""")
-        chroot("echo 'cat /proc/version > /etc/arch-release' > /etc/cron.daily/vmware-version-update")
-        chroot("chmod +x /etc/cron.daily/vmware-version-update")
+        create_cron_job('vmware-version-update', 'cat /proc/version > /etc/arch-release', 'daily')
 
-    pacman(gpu_packages)
-
-    if gpu == 'vmware':
-        enable_services(['vmtoolsd', 'vmware-vmblock-fuse'])
-    if gpu == 'vbox':
-        enable_services(['vboxservice'])
+    pacman(gpu_packages[gpu])
+    enable_services(gpu_services.get(gpu, []))
 
 
 def generate_fstab(fqdn, device=None):
-    sudo('genfstab -L "{0}" > "{0}/etc/fstab"'.format(env.dest))
+    sudo('genfstab -L "{0}" > "{0}/etc/fstab"'.format(context().dest))
 
 
 def network_config(fqdn):
     shortname = get_shortname(fqdn)
-    chroot('echo "%s" > "/etc/hostname"' % shortname)
-    chroot('echo "127.0.1.1\t{0}\t{1}" >> /etc/hosts'.format(fqdn, shortname))
+    write_file('/etc/hostname', shortname + '\n')
+    # Replaces the entry of an earlier run, which may have had another name
+    chroot(render.line_command('/etc/hosts', '127.0.1.1\t{0}\t{1}'.format(fqdn, shortname),
+                               replace='^127\\.0\\.1\\.1\\s'))
 
 
-def install_efi_bootloader(kernel_string, intel):
-    root_label = get_root_label()
+def install_efi_bootloader(kernel_string, intel, root_label, timeout=None):
     ucode_string = "\ninitrd   /intel-ucode.img" if intel else ''
     boot_loader_entry = """title    Arch Linux
 linux    /vmlinuz-""" + kernel_string + ucode_string + """
 initrd   /initramfs-{0}.img
 options  root=LABEL={1} rw quiet splash
-EOF""".format(kernel_string, root_label)
+""".format(kernel_string, root_label)
     chroot('bootctl install')
-    chroot("cat <<-EOF > /boot/loader/entries/arch.conf\n" +
-           boot_loader_entry)
+    write_file('/boot/loader/entries/arch.conf', boot_loader_entry)
+    if timeout is not None:
+        write_file('/boot/loader/loader.conf', 'default arch.conf\ntimeout %d\n' % timeout)
 
 
-def install_mbr_bootloader(kernel_string, intel):
-    root_label = get_root_label()
+def install_mbr_bootloader(kernel_string, intel, root_label):
     pacman(['syslinux'])
     chroot('sed -i "s|APPEND root=/dev/sda3|APPEND root=LABEL=%s|g"'
            ' /boot/syslinux/syslinux.cfg' % root_label)
@@ -184,8 +763,7 @@ def install_mbr_bootloader(kernel_string, intel):
     chroot('/usr/bin/syslinux-install_update -iam')
 
 
-def boot_loader(efi, kernel):
-    intel = not bool(sudo('grep GenuineIntel /proc/cpuinfo', warn_only=True, quiet=True).return_code)
+def boot_loader(efi, kernel, intel, root_label, timeout=None):
     kernel_string = 'linux'
 
     if intel:
@@ -197,11 +775,10 @@ def boot_loader(efi, kernel):
         pacman(['paxd'])
         set_sysctl('kernel.grsecurity.enforce_symlinksifowner', '0')
     if efi:
-        install_efi_bootloader(kernel_string, intel)
+        install_efi_bootloader(kernel_string, intel, root_label, timeout)
     else:
-        install_mbr_bootloader(kernel_string, intel)
+        install_mbr_bootloader(kernel_string, intel, root_label)
     chroot('touch /etc/os-release') # Fix for missing os-release sometimes?
-    chroot('/usr/bin/mkinitcpio -p %s' % kernel_string)
 
 
 def booleanize(value):
@@ -223,25 +800,25 @@ def booleanize(value):
 
 def create_cron_job(name, command, time):
     if time.lower() == 'daily':
-        chroot('echo "{0}" > /etc/cron.daily/{1}'.format(command, time))
+        write_file('/etc/cron.daily/%s' % name, render.cron_script(command), mode=0755)
     else:
-        chroot('echo "{0} {1}" > /etc/cron.d/{2}'.format(time, command, name))
+        write_file('/etc/cron.d/%s' % name, '%s root %s\n' % (time, command))
 
 
 def enable_services(services):
-    for service in services:
-        chroot("systemctl enable " + service)
+    if services:
+        chroot('systemctl enable ' + ' '.join(services))
 
 
 def set_locale():
-    chroot('echo LANG=en_AU.utf8 > /etc/locale.conf')
-    chroot('echo "en_AU.UTF-8 UTF-8" >> /etc/locale.gen')
-    chroot('echo "en_GB.UTF-8 UTF-8" >> /etc/locale.gen')
-    chroot('echo "en_US.UTF-8 UTF-8" >> /etc/locale.gen')
+    write_file('/etc/locale.conf', 'LANG=en_AU.utf8\n')
+    chroot(' && '.join(render.line_command('/etc/locale.gen', '%s.UTF-8 UTF-8' % locale)
+                       for locale in ['en_AU', 'en_GB', 'en_US']))
     chroot('locale-gen')
 
 
-def install_infinality():
+def enable_infinality_repo(target):
+    cmd = sudo if target == 'host' else chroot
     repo = """
 
 [infinality-bundle]
@@ -253,37 +830,49 @@ Server = http://bohoomil.com/repo/multilib/$(uname -m)
 [infinality-bundle-fonts]
 Server = http://bohoomil.com/repo/fonts
 EOF"""
-    chroot('cat <<EOF >> /etc/pacman.conf\n' + repo)
-    chroot('pacman-key -r 962DDE58')
-    chroot('pacman-key --lsign-key 962DDE58')
-    chroot('pacman -Sy')
-    chroot('yes|pacman -Sy freetype2-infinality-ultimate cairo-infinality-ultimate fontconfig-infinality-ultimate ibfonts-meta-extended ttf-noto-fonts-emoji-ib')
+    cmd("grep -q '^\\[infinality-bundle\\]' /etc/pacman.conf || "
+        "cat <<EOF >> /etc/pacman.conf\n" + repo)
+    import_infinality_key(target)
 
 
-def gui_install():
-    log('Installing GUI packages...')
-    pacman(gui_packages)
+def import_infinality_key(target):
+    ctx = context()
+    cmd = sudo if target == 'host' else chroot
+    if ctx.bundle and target != 'host':
+        sudo('cp {0}/keys/{1}.asc {2}/var/tmp/'.format(ctx.bundle, infinality_key, ctx.dest))
+        chroot('pacman-key --add /var/tmp/{0}.asc && rm /var/tmp/{0}.asc'.format(infinality_key))
+    else:
+        cmd('pacman-key -r %s' % infinality_key)
+    cmd('pacman-key --lsign-key %s' % infinality_key)
 
-    log('Enabling GUI services...')
-    enable_services(gui_services)
 
+def install_infinality():
+    ctx = context()
+    enable_infinality_repo('chroot')
+    if ctx.bundle:
+        # As pacman() does, from the host
+        flush_chroot()
+        sudo('yes|pacstrap -G -M -i %s %s' % (ctx.dest, ' '.join(infinality_packages)))
+    else:
+        chroot('yes|pacman -Sy %s' % ' '.join(infinality_packages))
+
+
+def gui_install(laptop):
     log('Installing infinality...')
     install_infinality()
 
     log('Installing plymouth...')
     install_plymouth()
 
-    install_laptop_tools()
+    if laptop:
+        install_laptop_tools()
 
 
 def install_laptop_tools():
-    if chroot('test -d /sys/class/power_supply/BAT*', warn_only=True).return_code == 0:
-        pacman(['xf86-input-synaptics'])
-
+    pacman(['xf86-input-synaptics'])
 
 
 def install_plymouth():
-    chroot('sed -i "/HOOKS/s/udev/udev plymouth/" /etc/mkinitcpio.conf')
     pacman(['plymouth-theme-arch-glow'])
     chroot('sed -i "s/Theme=.*/Theme=arch-glow/" /etc/plymouth/plymouthd.conf')
     chroot('sed -i "s/ShowDelay=.*/ShowDelay=1/" /etc/plymouth/plymouthd.conf')
@@ -292,54 +881,60 @@ def install_plymouth():
 def pam_config():
     login = """#%PAM-1.0
 
-    auth       required     pam_securetty.so
-    auth       requisite    pam_nologin.so
-    auth       include      system-local-login
-    auth       optional     pam_gnome_keyring.so
-    account    include      system-local-login
-    session    include      system-local-login
-    session    optional     pam_gnome_keyring.so        auto_start
-    """
+auth       required     pam_securetty.so
+auth       requisite    pam_nologin.so
+auth       include      system-local-login
+auth       optional     pam_gnome_keyring.so
+account    include      system-local-login
+session    include      system-local-login
+session    optional     pam_gnome_keyring.so        auto_start
+"""
     passwd = """#%PAM-1.0
-    #password   required    pam_cracklib.so difok=2 minlen=8 dcredit=2 ocredit=2 retry=3
-    #password   required    pam_unix.so sha512 shadow use_authtok
-    password    required    pam_unix.so sha512 shadow nullok
-    password    optional    pam_gnome_keyring.so
-    """
-    chroot('echo "%s" > /etc/pam.d/passwd' % passwd)
-    chroot('echo "%s" > /etc/pam.d/login' % login)
+#password   required    pam_cracklib.so difok=2 minlen=8 dcredit=2 ocredit=2 retry=3
+#password   required    pam_unix.so sha512 shadow use_authtok
+password    required    pam_unix.so sha512 shadow nullok
+password    optional    pam_gnome_keyring.so
+"""
+    write_file('/etc/pam.d/passwd', passwd)
+    write_file('/etc/pam.d/login', login)
 
 
 def journald_config():
-    config = """SyncIntervalSec=5m
+    # A drop-in rather than lines appended to journald.conf, which would
+    # pile up on every run
+    config = """[Journal]
+SyncIntervalSec=5m
 Compress=yes
-SystemMaxUse=256M"""
-    chroot("echo '%s' >> /etc/systemd/journald.conf" % config)
+SystemMaxUse=256M
+"""
+    write_file('/etc/systemd/journald.conf.d/fabulous.conf', config)
 
 
 def enable_wol():
     command = 'ACTION=="add", SUBSYSTEM=="net", KERNEL=="eth*", RUN+="/usr/bin/ethtool -s %k wol g"'
-    chroot("echo '%s' > /etc/udev/rules.d/50-wol.rules" % command)
+    write_file('/etc/udev/rules.d/50-wol.rules', command + '\n')
 
 
 def set_sysctl(key, value):
-    chroot("echo '{0} = {1}' > /etc/sysctl.d/{0}.conf".format(key, value))
+    write_file('/etc/sysctl.d/%s.conf' % key, '%s = %s\n' % (key, value))
 
 
-def sysctl_config():
-    sysctl = {}
-    sysctl['vm.dirty_bytes'] = '50331648'
-    sysctl['vm.dirty_background_bytes'] = '16777216'
-    sysctl['vm.vfs_cache_pressure'] = '50'
-    for key, value in sysctl.iteritems():
-        set_sysctl(key, value)
+def write_file(path, content, mode=0644):
+    """
+    Write content to path in the target. The file is uploaded with the
+    other files of its batch of chroot commands, and put in place in order
+    with them.
+    """
+    chroot(render.install_command(stage_file(content), path, mode))
 
 
 def configure_sudo():
     chroot("groupadd -f wheel")
-    chroot("""echo 'Defaults env_keep += "ZDOTDIR"' >> /etc/sudoers""")
-    chroot("""echo 'Defaults env_keep += "SSH_TTY"' >> /etc/sudoers""")
-    chroot("echo '%wheel ALL=(ALL) NOPASSWD: ALL' > /etc/sudoers.d/wheel")
+    # Drop-ins are replaced whole, where lines appended to /etc/sudoers
+    # would be added again on every run
+    write_file('/etc/sudoers.d/env_keep',
+               'Defaults env_keep += "ZDOTDIR"\nDefaults env_keep += "SSH_TTY"\n', mode=0440)
+    write_file('/etc/sudoers.d/wheel', '%wheel ALL=(ALL) NOPASSWD: ALL\n', mode=0440)
 
 
 def configure_settings():
@@ -356,105 +951,1008 @@ def get_shortname(fqdn):
         return fqdn
 
 
-def cleanup(device):
+def cleanup(devices):
     log('Cleaning up...')
-    while sudo('umount -l %s1' % device, quiet=True).return_code == 0:
-        pass
-    while sudo('umount -l %s2' % device, quiet=True).return_code == 0:
-        pass
-    sudo('rmdir %s' % env.dest, quiet=True)
+    # A partition can be mounted several times over, so each is unmounted
+    # until umount fails
+    partitions = [partition for device in devices for partition in get_boot_and_root(device)]
+    sudo('for partition in {0}; do while umount -l $partition 2>/dev/null; do :; done; done; '
+         'rmdir {1}'.format(' '.join(partitions), context().dest), quiet=True)
 
 
 def install_ssh_key(keyfile, user):
-    home = chroot('getent passwd %s|cut -d: -f6' % user)
-    chroot('mkdir -p %s/.ssh' % home, user=user)
-    chroot('chmod 700 %s/.ssh' % home, quiet=True)
-    chroot('chown {0} {1}/.ssh'.format(user, home))
-    put(local_path=keyfile,
-        remote_path='{0}/{1}/.ssh/authorized_keys'.format(env.dest, home),
-        use_sudo=True,
-        mode=0600)
-    chroot('chown -R {0}. {1}/.ssh'.format(user, home))
+    # ~user is expanded inside the chroot, so the home directory does not
+    # need to be looked up first
+    with open(keyfile) as f:
+        source = stage_file(f.read())
+    chroot('install -d -m 700 ~{0}/.ssh && install -m 600 {1} ~{0}/.ssh/authorized_keys && '
+           'rm {1} && chown -R {0}: ~{0}/.ssh'.format(user, source))
 
 
-def get_root_label():
-    device = sudo("mount | grep ' on %s ' | awk '{print $1}'" % env.dest, quiet=True)
-    return sudo("lsblk -o label %s | tail -n1" % device, quiet=True)
+def root_label_command(mountpoint):
+    return """lsblk -o label "$(mount | grep ' on %s ' | awk '{print $1}')" | tail -n1""" % mountpoint
 
 
 def get_boot_and_root(device):
-    return ['%s1' % device, '%s2' % device]
+    return [disks.partition_path(device, 1), disks.partition_path(device, 2)]
 
 
-def create_efi_layout(device, shortname):
-    boot, root = get_boot_and_root(device)
-    sudo('echo -e "o\ny\nn\n\n\n+200M\nef00\nn\n\n\n\n\nw\ny\n" | gdisk "%s"'
-         % device, quiet=True)
-    sudo('wipefs -a %s' % boot)
-    sudo('wipefs -a %s' % root)
-    sudo('mkfs.vfat -F32 %s -n "boot"' % boot)
+def attach_disk_image(path, size):
+    """
+    Create a sparse disk image of size at path on the host, unless it
+    already exists, and attach it to a loop device with partition scanning.
+    Returns the loop device.
+    """
+    log('Attaching disk image %s...' % path)
+    return sudo('[ -e "{0}" ] || truncate -s {1} "{0}"; losetup -P --show -f "{0}"'.format(
+        path, size))
 
 
-def create_bios_layout(device, shortname):
-    # Use parted to create a blank partition table, it correctly clears GPT
-    # tables as well, unlike fdisk
-    boot, root = get_boot_and_root(device)
-    sudo('parted -s %s mklabel msdos' % device)
-    sudo('echo -e "n\n\n\n\n+200M\nn\n\n\n\n\nw\n" | fdisk "%s"'
-         % device, quiet=True)
-    sudo('wipefs -a %s' % boot)
-    sudo('wipefs -a %s' % root)
-    sudo('mkfs.ext4 -m 0 -L "boot" "%s"' % boot)
+def trim_disk_image():
+    # Discarding the free space punches it back out of the sparse image
+    sudo('fstrim "{0}/boot"; fstrim "{0}"'.format(context().dest), quiet=True)
 
 
-def prepare_device(device, shortname, efi):
-    # TODO: unmount all partitions on the device if they are mounted
-    # Create partitions; 200M sdX1 and the rest as sdX2. Layout differs for EFI
-    if efi:
-        create_efi_layout(device, shortname)
-    else:
-        create_bios_layout(device, shortname)
+def compress_disk_image(path):
+    """
+    Compress the disk image at path to path.zst. zstd -d restores it as a
+    sparse file again.
+    """
+    log('Compressing disk image to %s.zst...' % path)
+    sudo('zstd -T0 -q -f "{0}" -o "{0}.zst"'.format(path))
 
-    boot, root = get_boot_and_root(device)
 
-    sudo('mkfs.btrfs -L "%s-btrfs" "%s"' % (shortname, root))
+def prepare_device(devices, shortname, efi, image=None):
+    # Partition and format every disk in one go; 200M sdX1 for boot and the
+    # rest as sdX2 for root. Layout differs for EFI
+    sudo(disks.prepare_script(devices, efi, '%s-btrfs' % shortname))
+
+    boot, root = get_boot_and_root(devices[0])
+    dest = context().dest
+
     # Set up root as the default btrfs subvolume
     try:
-        sudo('mount "%s" "%s"' % (root, env.dest))
-        sudo('btrfs subvolume create "%s/root"' % env.dest)
-        subvols = sudo('btrfs subvolume list "%s"' % env.dest)
-        subvolid = re.findall('ID (\d+).*level 5 path root$',
-                              subvols, re.MULTILINE)[0]
-        sudo('btrfs subvolume set-default "%s" "%s"'
-             % (subvolid, env.dest))
-        sudo('umount -l "%s"' % env.dest)
+        sudo('mount "%s" "%s"' % (root, dest))
+        if image:
+            receive_image(image, boot)
+        else:
+            sudo('btrfs subvolume create "%s/root"' % dest)
+        sudo('btrfs subvolume set-default "%s/root"' % dest)
+        create_subvolumes()
+        sudo('umount -l "%s"' % dest)
 
         # Mount all of the things
-        sudo('mount -o relatime "%s" "%s"' % (root, env.dest))
-        sudo('mkdir "%s/boot"' % env.dest)
-        sudo('mount "%s" "%s/boot"' % (boot, env.dest))
+        mount_device(devices[0])
     except:
-        cleanup(device)
+        cleanup(devices)
+        raise
+
+
+def receive_image(image, boot):
+    """
+    Lay down a base image made by build_image as the root subvolume of the
+    freshly formatted device, and copy its /boot to the boot partition.
+    """
+    dest = context().dest
+    log('Copying base image...')
+    put(local_path=image, remote_path='%s/base.img.zst' % dest, use_sudo=True)
+    sudo('zstd -dc "{0}/base.img.zst" | btrfs receive "{0}"'.format(dest))
+    sudo('rm "%s/base.img.zst"' % dest)
+    sudo('btrfs subvolume snapshot "{0}/base" "{0}/root"'.format(dest))
+    sudo('btrfs subvolume delete "%s/base"' % dest)
+    sudo('mkdir "{0}/.boot" && mount "{1}" "{0}/.boot"'.format(dest, boot))
+    sudo('cp -a "{0}/root/boot/." "{0}/.boot/" && rm -rf "{0}/root/boot/"*'.format(dest))
+    sudo('umount "{0}/.boot" && rmdir "{0}/.boot"'.format(dest))
+
+
+def profile_subvolumes():
+    return [] if context().fs_profile == 'default' else fs_subvolumes
+
+
+def create_subvolumes():
+    """
+    Create the subvolumes of the fs_profile next to root, on the top level
+    of the btrfs filesystem mounted on the target.
+    """
+    dest = context().dest
+    for name, _, nodatacow in profile_subvolumes():
+        sudo('btrfs subvolume create "%s/%s"' % (dest, name))
+        if nodatacow:
+            # Inherited by every file created in it
+            sudo('chattr +C "%s/%s"' % (dest, name))
+
+
+def mount_device(device):
+    """
+    Mount the root and boot partitions of device on the target, with the
+    subvolumes and mount options of the fs_profile, and check that both
+    are mounted. genfstab copies the options into the installed fstab.
+    """
+    boot, root = get_boot_and_root(device)
+    ctx = context()
+    dest = ctx.dest
+    options = ','.join(fs_profiles[ctx.fs_profile])
+    scan = ''
+    if len(ctx.devices) > 1:
+        # Every member of a multi-disk btrfs must be known before it mounts
+        scan = 'btrfs device scan >/dev/null && '
+    sudo('%smount -o %s "%s" "%s"' % (scan, options, root, dest))
+    for name, path, _ in profile_subvolumes():
+        sudo('mkdir -p "{0}{1}" && mount -o {2},subvol=/{3} "{4}" "{0}{1}"'.format(
+            dest, path, options, name, root))
+    sudo('mkdir -p "%s/boot"' % dest)
+    sudo('mount "%s" "%s/boot"' % (boot, dest))
+    if sudo('mountpoint -q "{0}" && mountpoint -q "{0}/boot"'.format(dest), quiet=True).failed:
+        raise RuntimeError("Failed to mount %s on %s" % (device, dest))
 
 
 def set_timezone():
     # temporarily install this until fixed upstream. Should just need tzupdate call
     pacman(['python-setuptools'])
+    if context().bundle:
+        # tzupdate looks the timezone up online
+        chroot('ln -sf /usr/share/zoneinfo/UTC /etc/localtime')
+        return
     chroot('touch /etc/localtime')
     chroot('tzupdate')
 
 
 def log(message):
-    time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    print("*** {0} *** {1}".format(time, message))
+    ctx = _contexts.get(env.host_string)
+    if ctx and ctx.script is not None:
+        # Printed when the compiled script reaches this point
+        ctx.script.append(('event', 'log %s' % message, False))
+        return
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    if env.get('fleet'):
+        message = '[{0}] {1}'.format(env.host_string, message)
+    line = "*** {0} *** {1}".format(now, message)
+    print(line)
+    if ctx:
+        ctx.trace.append({'name': message, 'cat': 'log', 'ph': 'i', 's': 'p',
+                          'pid': 1, 'tid': 1,
+                          'ts': int((time.time() - ctx.start) * 1e6)})
+        if ctx.log_path:
+            with open(ctx.log_path, 'a') as f:
+                f.write(ctx.redact(line) + '\n')
+
+
+def setup_host(ctx):
+    if ctx.bundle:
+        log('Installing from the offline bundle...')
+        use_bundle(ctx)
+    else:
+        log('Enabling dray.be repo during install...')
+        enable_dray_repo('host')
+
+        log('Enabling multilib repo during install...')
+        enable_multilib_repo('host')
+
+    log('Enabling mDNS during install...')
+    enable_mdns('host')
+
+    if ctx.mirrors:
+        log('Using %s during install...' % ', '.join(ctx.mirrors))
+        write_mirrorlist('host', ctx.mirrors)
+    if ctx.parallel_downloads:
+        enable_parallel_downloads('host', ctx.parallel_downloads)
+
+    if ctx.package_cache:
+        log('Using package cache during install...')
+        enable_package_cache('host', ctx.cache_port)
+
+
+def upload_bundle(ctx, path):
+    """
+    Unpack the local offline bundle at path on the host, unless the same
+    bundle is there already from an earlier install.
+    """
+    path = os.path.expanduser(path)
+    manifest = offline.read_manifest(path)
+    uploaded = sudo('cat %s/manifest.json' % offline.remote_dir, quiet=True)
+    if uploaded.succeeded and manifest['id'] in uploaded:
+        log('Bundle %s is on the host already' % manifest['id'])
+    else:
+        log('Uploading bundle %s of %d packages...' % (manifest['id'], len(manifest['packages'])))
+        sudo('rm -rf {0} && mkdir -p {0}'.format(offline.remote_dir))
+        put(path, offline.remote_dir + '.tar')
+        sudo('tar -C {0} -xf {0}.tar && rm {0}.tar'.format(offline.remote_dir))
+    ctx.bundle = offline.remote_dir
+
+
+def use_bundle(ctx):
+    """
+    Make the bundle the only repository of the host, and trust the keys of
+    the third party repositories it holds packages from. The host's own
+    pacman.conf is kept, unless an interrupted install kept it already, and
+    put back by restore_host_pacman_conf().
+    """
+    sudo('{{ [ -e {1} ] || cp /etc/pacman.conf {1}; }} && cp {0}/pacman.conf /etc/pacman.conf && '
+         'for key in {0}/keys/*.asc; do [ -e "$key" ] || continue; '
+         'pacman-key --add "$key" && pacman-key --lsign-key "$(basename "$key" .asc)"; done'.format(
+             ctx.bundle, host_pacman_conf_backup))
+
+
+def restore_host_pacman_conf():
+    sudo('if [ -e {0} ]; then mv {0} /etc/pacman.conf; fi'.format(host_pacman_conf_backup),
+         quiet=True)
+
+
+def configure_chroot_mirrors(ctx):
+    # pacstrap copies the host's mirrorlist, but a resumed install or one
+    # from an image has its own. pacman.conf always comes from the package
+    if ctx.mirrors:
+        write_mirrorlist('chroot', ctx.mirrors)
+    if ctx.parallel_downloads:
+        enable_parallel_downloads('chroot', ctx.parallel_downloads)
+    if ctx.package_cache:
+        log('Using package cache in chroot...')
+        enable_package_cache('chroot', ctx.cache_port)
+
+
+def install_base(ctx):
+    mask_initramfs_hooks(ctx)
+    log('Installing base OS (may take a few minutes)...')
+    pacman(['base'], pacstrap=True, remote=ctx.remote)
+    configure_chroot_mirrors(ctx)
+
+
+def install_base_packages(ctx):
+    log('Enabling dray.be repo...')
+    enable_dray_repo('chroot')
+
+    log('Enabling multilib repo...')
+    enable_multilib_repo('chroot')
+
+    # Everything the remaining phases need, so that their own pacman()
+    # calls have nothing left to do
+    packages = sorted(set(package for name, packages in plan_packages(ctx)
+                          if name not in ctx.completed for package in packages))
+    log('Installing packages for all phases (may take a few minutes)...')
+    pacman(packages)
+    ctx.installed.update(packages)
+
+
+def initramfs_hook_names(ctx):
+    hooks = list(initramfs_hooks)
+    if ctx.kernel:
+        hooks.append('90-linux-%s.hook' % ctx.kernel)
+    return hooks
+
+
+def mask_initramfs_hooks(ctx):
+    """
+    Stop pacman from rebuilding the initramfs on every kernel, mkinitcpio or
+    module package installed, until build_initramfs() runs. Created before
+    pacstrap, so the hooks are masked from the first package on.
+    """
+    hooks = '{0}/etc/pacman.d/hooks'.format(ctx.dest)
+    sudo('mkdir -p {0} && cd {0} && for hook in {1}; do ln -sf /dev/null $hook; done'.format(
+        hooks, ' '.join(initramfs_hook_names(ctx))))
+
+
+def initramfs_edits(ctx):
+    """
+    Return the sed expressions adding the modules and hooks the install
+    needs to mkinitcpio.conf. Each one is safe to apply more than once.
+    """
+    edits = []
+    if ctx.gui:
+        module = gpu_modules.get(ctx.gpu)
+        if module:
+            edits.append("""/^MODULES=/{/\\b%s\\b/!s/MODULES="/MODULES="%s /}""" % (module, module))
+        edits.append("/^HOOKS=/{/plymouth/!s/udev/udev plymouth/}")
+    if len(ctx.devices) > 1:
+        # Assembles the multi-disk root before it is mounted
+        edits.append("/^HOOKS=/{/btrfs/!s/filesystems/btrfs filesystems/}")
+    return edits
+
+
+def build_initramfs(ctx):
+    """
+    Apply every mkinitcpio.conf change in one go, unmask the pacman hooks
+    and build each preset once. The masked mkinitcpio-install hook is also
+    what copies each kernel to /boot, so it is run for every installed
+    kernel instead of building the presets alone.
+    """
+    log('Building initramfs...')
+    edits = initramfs_edits(ctx)
+    if edits:
+        chroot("sed -i %s /etc/mkinitcpio.conf" % ' '.join("-e '%s'" % edit for edit in edits))
+    chroot('cd /etc/pacman.d/hooks && rm -f %s' % ' '.join(initramfs_hook_names(ctx)))
+    # The hook script takes the kernels as pacman passes them, relative to /.
+    # Older mkinitcpio without it leaves the kernels to their own packages
+    chroot('if [ -x {0} ]; then cd / && ls usr/lib/modules/*/vmlinuz | {0}; '
+           'else /usr/bin/mkinitcpio -P; fi'.format(mkinitcpio_install))
+    chroot("ls /boot/vmlinuz-* > /dev/null || { echo 'No kernel in /boot' >&2; exit 1; }")
+
+
+def configure_sudoers(ctx):
+    log('Configuring sudo...')
+    configure_sudo()
+
+
+def create_users(ctx):
+    password = ctx.password or generate_password(16)
+    root_password = password
+    username = ctx.username
+    ctx.secrets.append(password)
+
+    # set +x keeps bash -ex from echoing the passwords into the output
+    if username:
+        log('Creating user %s...' % username)
+        chroot('useradd -m %s -G wheel' % username)
+        log('Setting %s account password...' % username)
+        chroot("set +x; echo '{0}:{1}' | chpasswd".format(username, password))
+        root_password = generate_password(16)
+        ctx.secrets.append(root_password)
+    else:
+        username = 'root'
+
+    log('Setting root password...')
+    chroot("set +x; echo 'root:{0}' | chpasswd".format(root_password))
+
+    if ctx.ssh_key:
+        log('Installing ssh key...')
+        install_ssh_key(ctx.ssh_key, username)
+
+
+def configure_network(ctx):
+    log('Configuring network...')
+    network_config(ctx.fqdn)
+
+    log('Generating fstab...')
+    generate_fstab(ctx.fqdn, ctx.device)
+
+
+def configure_mdns(ctx):
+    log('Configuring mDNS...')
+    enable_mdns('chroot')
+
+
+def enable_base_services(ctx):
+    log('Configuring %s services...' % ctx.role['name'])
+    enable_services(ctx.role['services'])
+
+
+def create_cron_jobs(ctx):
+    log('Setting up cron jobs...')
+    create_cron_job('create-package-list', 'pacman -Qe > /etc/package-list', time='daily')
+    create_cron_job('udpate-pkgfile', 'pkgfile -u &>/dev/null', time='daily')
+
+
+def configure_locale(ctx):
+    log('Setting default locale...')
+    set_locale()
+
+
+def configure_timezone(ctx):
+    log('Setting default timezone...')
+    set_timezone()
+
+
+def install_gui(ctx):
+    gpu_install(ctx.gpu)
+    gui_install(ctx.laptop)
+
+
+def apply_settings(ctx):
+    log('Configuring settings...')
+    configure_settings()
+
+
+def install_extra_packages(ctx):
+    log('Installing additional packages...')
+    pacman(ctx.extra_packages)
+
+
+def install_boot_loader(ctx):
+    log('Installing boot loader...')
+    boot_loader(efi=ctx.efi, kernel=ctx.kernel, intel=ctx.intel,
+                root_label=ctx.root_label, timeout=ctx.boot and ctx.boot['loader_timeout'])
+    build_initramfs(ctx)
+
+
+def select_role(ctx, role, gui):
+    """
+    Resolve role into ctx.role, defaulting to workstation with a GUI and
+    base without. The role decides whether a GUI is installed.
+    """
+    try:
+        ctx.role = roles.resolve(role or ('workstation' if gui else 'base'))
+    except ValueError as e:
+        raise RuntimeError(str(e))
+    if gui and not ctx.role['gui']:
+        raise RuntimeError("Role %s has no GUI" % ctx.role['name'])
+    if ctx.role['tuning_profile'] not in tuning.profiles:
+        raise RuntimeError("Invalid tuning_profile in role %s" % ctx.role['name'])
+    ctx.gui = ctx.role['gui']
+    log('Role %s (%s): %d packages, %d services' % (
+        ctx.role['name'], ctx.role['hash'], len(ctx.role['packages']), len(ctx.role['services'])))
+
+
+def detect_hardware(ctx):
+    """
+    Work out everything later decisions depend on from the host's facts
+    before the install starts, so that no phase needs to read the output of
+    a command.
+    """
+    ctx.intel = facts.intel(ctx.facts)
+    ctx.laptop = facts.laptop(ctx.facts)
+    if ctx.gui and ctx.gpu == 'auto':
+        ctx.gpu = facts.gpu(ctx.facts)
+    # The host's own disk says nothing about a target on another one
+    disk, rotational = ctx.disk
+    if not disk and ctx.device:
+        disk = os.path.basename(ctx.device)
+    ctx.tuning = tuning.tune(facts.tuning_facts(ctx.facts, disk, rotational), ctx.tuning_profile,
+                             ctx.tuning_overrides, ctx.laptop, ctx.gui)
+    if ctx.fast_boot or ctx.boot_report:
+        ctx.boot = boottime.plan(ctx.tuning['profile'] if ctx.fast_boot else 'none',
+                                 ctx.tuning['facts']['disk_type'], ctx.efi,
+                                 ctx.role['services'], ctx.boot_report)
+
+
+def collect_facts(probes, refresh=False, ttl=86400, path=None):
+    """
+    Run probes, a dict as taken by probe(), together with the probe of the
+    host's facts, and return their results and the facts. The facts are
+    loaded from the local JSON file path instead if it is given, and the
+    cache is ignored if refresh is set.
+    """
+    if path:
+        return probe(probes), facts.load_file(path)
+    cached = None if refresh else facts.load(env.host_string, ttl)
+    results = probe(dict(probes, facts=facts.command(cached)))
+    host_facts = facts.parse(results['facts'], cached)
+    if not host_facts['cached']:
+        facts.save(env.host_string, host_facts)
+    return results, host_facts
+
+
+def apply_tuning(ctx):
+    log('Tuning for the %s profile...' % ctx.tuning['profile'])
+    for reason in ctx.tuning['reasons']:
+        log('  %s' % reason)
+    write_file('/etc/fabulous/tuning.json', tuning.report(ctx.tuning) + '\n')
+    if ctx.tuning['profile'] == 'none':
+        return
+    pacman(tuning.packages)
+    write_file('/etc/sysctl.d/90-fabulous.conf', tuning.sysctl_conf(ctx.tuning))
+    write_file('/etc/udev/rules.d/60-ioschedulers.rules', tuning.scheduler_rules)
+    if ctx.tuning['zram']:
+        write_file('/etc/systemd/zram-generator.conf', tuning.zram_conf(ctx.tuning))
+    if ctx.tuning['governor']:
+        chroot("sed -i \"s/^#\\?governor=.*/governor='%s'/\" /etc/default/cpupower" % ctx.tuning['governor'])
+        enable_services(['cpupower'])
+
+
+def optimise_boot(ctx):
+    log('Tuning boot for the %s profile...' % ctx.boot['profile'])
+    for reason in ctx.boot['reasons']:
+        log('  %s' % reason)
+    write_file('/etc/fabulous/boot.json', boottime.report(ctx.boot) + '\n')
+    if ctx.boot['compression']:
+        # Read by the mkinitcpio -P of the boot loader phase
+        write_file('/etc/mkinitcpio.conf.d/fabulous.conf',
+                   'COMPRESSION="%s"\n' % ctx.boot['compression'])
+    sockets = ctx.boot['sockets']
+    if sockets:
+        chroot('systemctl disable {0} && systemctl enable {1}'.format(
+            ' '.join(sorted(sockets)), ' '.join(sockets[service] for service in sorted(sockets))))
+    if ctx.boot['disable']:
+        chroot('systemctl disable ' + ' '.join(ctx.boot['disable']))
+    if ctx.boot['report']:
+        write_file(boottime.report_script_path, boottime.report_script, mode=0755)
+        write_file('/etc/systemd/system/fabulous-boot-report.service', boottime.report_unit)
+        enable_services(['fabulous-boot-report'])
+
+
+def compile_step(index, command, tolerate):
+    return """step {0} {1} <<'FABULOUS_STEP'
+{2}
+FABULOUS_STEP
+""".format(index, int(tolerate), command)
+
+
+def compile_script(commands):
+    """
+    Turn the commands recorded for a compiled install into one bash script.
+    Progress is reported on stdout with lines starting with @@fabulous.
+    """
+    script = """#!/bin/bash
+event() { echo "@@fabulous $*"; }
+step() {
+    local f rc
+    f=$(mktemp)
+    cat > "$f"
+    event step $1
+    bash -l "$f"
+    rc=$?
+    rm -f "$f"
+    if [[ $rc != 0 && $2 == 0 ]]; then
+        event failed $1 $rc
+        exit $rc
+    fi
+}
+"""
+    for index, (kind, command, tolerate) in enumerate(commands):
+        if kind == 'event':
+            script += 'event %s\n' % pipes.quote(command)
+        else:
+            script += compile_step(index, command, tolerate)
+    return script
+
+
+class PacmanProgress(object):
+    """
+    File-like object receiving the output of pacman or pacstrap as it runs.
+    Download and install progress is parsed as it arrives and shown as a
+    single updating line, and corrupted packages and failed transactions
+    are reported as soon as pacman prints them. Only the last lines of the
+    output, without progress bar updates, are kept for error reports.
+    """
+    prefix = re.compile(r'^\[[^\]]*\] out: ?')
+    bar = re.compile(r'\[[-#o ]+\]\s+\d+%\s*$')
+    total = re.compile(r'^\s*Total \(\s*(\d+)/(\d+)\)\s+(\S+ \S+)\s+(\S+ \S+/s)\s+(\d+:\d+)')
+    step = re.compile(r'^\(\s*(\d+)/(\d+)\) (?:installing|upgrading|reinstalling|downgrading) (\S+)')
+    corrupted_package = re.compile(r'(\S+) is invalid or corrupted')
+
+    def __init__(self, label, tail=200):
+        self.label = label
+        self.partial = ''
+        self.lines = deque(maxlen=tail)
+        self.corrupted = []
+        self.status = None
+        self.install_start = None
+        self.shown = 0
+        self.milestone = 0
+
+    def write(self, data):
+        self.partial += data
+        # Progress bars are redrawn after a carriage return
+        parts = re.split(r'\r\n|\r|\n', self.partial)
+        self.partial = parts.pop()
+        for part in parts:
+            self.handle(self.prefix.sub('', part))
+
+    def flush(self):
+        pass
+
+    def handle(self, line):
+        if not line.strip():
+            return
+        if not self.bar.search(line):
+            self.lines.append(line)
+        total = self.total.match(line)
+        step = self.step.match(line)
+        corrupted = self.corrupted_package.search(line)
+        if total:
+            self.status = 'downloading {0}/{1} packages, {2} at {3}, ETA {4}'.format(
+                *total.groups())
+        elif step:
+            done, count, name = int(step.group(1)), int(step.group(2)), step.group(3)
+            if not self.install_start:
+                self.install_start = time.time()
+            self.status = 'installing {0}/{1} ({2}%) {3}'.format(
+                done, count, 100 * done / count, name)
+            elapsed = time.time() - self.install_start
+            if done > 1 and elapsed:
+                self.status += ', ETA %s' % format_duration(elapsed / (done - 1) * (count - done + 1))
+            if env.get('fleet') and 100 * done / count >= self.milestone + 25:
+                self.milestone = 100 * done / count / 25 * 25
+                log('{0}: installed {1}%'.format(self.label, self.milestone))
+        elif corrupted and corrupted.group(1) not in self.corrupted:
+            self.corrupted.append(corrupted.group(1))
+            self.clear()
+            log('{0}: {1} is corrupted, it will be downloaded again'.format(
+                self.label, corrupted.group(1)))
+        elif 'Failed to install packages' in line or 'unrecognized option' in line:
+            self.clear()
+            log('{0}: {1}'.format(self.label, line.strip()))
+        self.show()
+
+    def show(self):
+        # A fleet's output is interleaved, so it only gets milestones
+        if not self.status or env.get('fleet') or time.time() - self.shown < 0.5:
+            return
+        self.shown = time.time()
+        sys.stdout.write('\r\033[K{0}: {1}'.format(self.label, self.status))
+        sys.stdout.flush()
+
+    def clear(self):
+        if self.shown:
+            sys.stdout.write('\r\033[K')
+            sys.stdout.flush()
+            self.shown = 0
+
+    def close(self):
+        if self.partial:
+            self.handle(self.prefix.sub('', self.partial))
+            self.partial = ''
+        self.clear()
+
+
+class ProgressStream(object):
+    """
+    File-like object receiving the output of a compiled install. Progress
+    events are turned back into log messages and phase timings, and only
+    the last lines of everything else are kept for error reports.
+    """
+
+    def __init__(self, ctx, tail=200):
+        self.ctx = ctx
+        self.partial = ''
+        self.lines = deque(maxlen=tail)
+        self.phase_start = {}
+        self.failed = None
+        self.progress = PacmanProgress('install')
+
+    def write(self, data):
+        self.partial += data
+        while '\n' in self.partial:
+            line, self.partial = self.partial.split('\n', 1)
+            self.handle(line.rstrip('\r'))
+
+    def flush(self):
+        pass
+
+    def handle(self, line):
+        if '@@fabulous ' not in line:
+            self.lines.append(line)
+            self.progress.write(line + '\n')
+            return
+        self.progress.clear()
+        event, _, data = line.split('@@fabulous ', 1)[1].partition(' ')
+        if event == 'log':
+            log(data)
+        elif event == 'phase-start':
+            self.phase_start[data] = time.time()
+            self.progress.label = data
+        elif event == 'phase-end':
+            start = self.phase_start.pop(data, time.time())
+            self.ctx.phases.append((data, time.time() - start))
+            self.ctx.trace.append({
+                'name': data, 'cat': 'phase', 'ph': 'X', 'pid': 1, 'tid': 1,
+                'ts': int((start - self.ctx.start) * 1e6),
+                'dur': int((time.time() - start) * 1e6), 'args': {}})
+        elif event == 'step':
+            self.lines.clear()
+        elif event == 'failed':
+            self.failed = [int(n) for n in data.split()]
+
+
+def run_compiled_script(ctx):
+    """Upload the recorded install as a single script and run it."""
+    commands, ctx.script = ctx.script, None
+    script_path = '/var/tmp/fabulous-install.sh'
+    local = tempfile.NamedTemporaryFile(suffix='.sh', delete=False)
+    try:
+        local.write(compile_script(commands))
+        local.close()
+        log('Running compiled install of %d commands...' % len(commands))
+        put(local_path=local.name, remote_path=script_path, use_sudo=True, mode=0700)
+    finally:
+        os.unlink(local.name)
+    stream = ProgressStream(ctx)
+    with show('stdout'):
+        out = sudo('bash %s; rc=$?; rm -f %s; exit $rc' % (script_path, script_path),
+                   stdout=stream, warn_only=True)
+    stream.progress.close()
+    if out.failed:
+        if stream.failed:
+            index, return_code = stream.failed
+            abort(redact('Command failed with exit code {0}: {1}\n{2}'.format(
+                return_code, commands[index][1].strip(), '\n'.join(stream.lines))))
+        abort('Compiled install failed:\n%s' % '\n'.join(stream.lines))
+
+
+def reset_host_identity(ctx):
+    """
+    Regenerate everything that has to be unique per machine but was shared
+    through the base image. The new keyring only trusts the Arch keys, so
+    the third party keys the image trusted are imported and signed again.
+    """
+    log('Generating machine id, ssh host keys and pacman keyring...')
+    chroot('rm -f /etc/machine-id && systemd-machine-id-setup')
+    chroot('rm -f /etc/ssh/ssh_host_* && ssh-keygen -A')
+    chroot('rm -rf /etc/pacman.d/gnupg && pacman-key --init && pacman-key --populate archlinux')
+    if ctx.gui:
+        import_infinality_key('chroot')
+
+
+def plan_packages(ctx):
+    """
+    Return the packages each phase of the install needs from the standard
+    repositories, as (phase name, packages) pairs. Infinality comes from its
+    own repository and is installed separately.
+    """
+    plan = [
+        ('base packages', ctx.role['packages']),
+        ('timezone', ['python-setuptools']),
+    ]
+    if ctx.gui:
+        gui = gpu_packages.get(ctx.gpu, []) + ['plymouth-theme-arch-glow']
+        if ctx.laptop:
+            gui.append('xf86-input-synaptics')
+        plan.append(('gui', gui))
+    if ctx.extra_packages:
+        plan.append(('extra packages', ctx.extra_packages))
+    boot = []
+    if ctx.intel:
+        boot.append('intel-ucode')
+    if ctx.kernel:
+        boot += ['linux-%s' % ctx.kernel, 'linux-%s-headers' % ctx.kernel]
+    if ctx.kernel == 'grsec':
+        boot.append('paxd')
+    if not ctx.efi:
+        boot.append('syslinux')
+    plan.append(('tuning', tuning.packages))
+    plan.append(('boot loader', boot))
+    return plan
+
+
+def package_stages(ctx):
+    """
+    Return the packages the install will need, as the 'base' stage needed by
+    pacstrap and the 'all' stage needed by every other phase.
+    """
+    packages = set(package for _, packages in plan_packages(ctx) for package in packages)
+    return [('base', ['base']), ('all', sorted(packages))]
+
+
+def start_prefetch(ctx):
+    """
+    Start downloading every package of the install in the background on the
+    host, into the cache pacstrap and the chroot will install from: the
+    host's cache for pacstrap unless the install is remote, and the target's
+    own cache for pacman in the chroot, which never reads the host's.
+    """
+    target_cache = '%s/var/cache/pacman/pkg' % ctx.dest
+    caches = {'base': target_cache if ctx.remote else '/var/cache/pacman/pkg'}
+    stages = package_stages(ctx)
+    log('Prefetching %d packages in the background...' % len(stages[-1][1]))
+    script = 'rm -rf {0} && mkdir -p {0}\n'.format(prefetch_dir)
+    script += "cat <<'EOF' > {0}/prefetch.sh\n{1}EOF\n".format(prefetch_dir, prefetch_script)
+    for stage, packages in stages:
+        script += "echo '{0}' > {1}/{2}\n".format('\n'.join(packages), prefetch_dir, stage)
+    script += "echo '{0}' > {1}/stages".format('\n'.join(
+        '%s %s' % (stage, caches.get(stage, target_cache)) for stage, _ in stages), prefetch_dir)
+    sudo(script)
+    sudo('nohup setsid bash {0}/prefetch.sh {0} {1} > {0}/log 2>&1 < /dev/null & echo $! > {0}/pid'.format(
+        prefetch_dir, int(ctx.prefetch_workers)), pty=False)
+    ctx.prefetch = [stage for stage, _ in stages]
+
+
+def wait_for_prefetch(stage):
+    """
+    Block until the prefetch has finished stage, or has stopped. Packages it
+    could not fetch are left for pacman to download.
+    """
+    ctx = context()
+    if stage not in ctx.prefetch:
+        return
+    with traced('wait for %s prefetch' % stage, 'prefetch'):
+        out = sudo('while [ ! -e {0}/{1}.done ] && kill -0 $(cat {0}/pid) 2>/dev/null; '
+                   'do sleep 1; done; cat {0}/{1}.failed 2>/dev/null'.format(prefetch_dir, stage),
+                   quiet=True)
+    if out.strip():
+        log('Failed to prefetch %d packages, leaving them to pacman' % len(out.splitlines()))
+    ctx.prefetch.remove(stage)
+
+
+def install_phases(ctx):
+    """
+    Return the checkpointed phases of the install, in order, as
+    (name, function) pairs. Each function is called with the InstallContext.
+    The phases named in host_phases come last.
+    """
+    phases = [
+        ('pacstrap', install_base),
+        ('base packages', install_base_packages),
+        ('mdns', configure_mdns),
+        ('services', enable_base_services),
+        ('cron', create_cron_jobs),
+        ('locale', configure_locale),
+        ('timezone', configure_timezone),
+    ]
+    if ctx.gui:
+        phases.append(('gui', install_gui))
+    phases.append(('settings', apply_settings))
+    if ctx.extra_packages:
+        phases.append(('extra packages', install_extra_packages))
+    phases.append(('sudo', configure_sudoers))
+    if ctx.image:
+        phases.append(('host identity', reset_host_identity))
+    phases += [
+        ('tuning', apply_tuning),
+        ('users', create_users),
+        ('network', configure_network),
+    ]
+    if ctx.boot:
+        phases.append(('boot', optimise_boot))
+    phases.append(('boot loader', install_boot_loader))
+    return phases
+
+
+def load_checkpoints():
+    """Return the phases recorded as completed in the target's state file."""
+    ctx = context()
+    out = sudo('cat %s%s' % (ctx.dest, state_file), quiet=True)
+    if not out.succeeded:
+        return set()
+    return set(line.strip() for line in out.splitlines() if line.strip())
+
+
+def run_phase(name, func):
+    """
+    Run a phase of the install unless the state file in the target already
+    records it as completed, and record it once it succeeds.
+    """
+    ctx = context()
+    if name in ctx.completed:
+        log('Skipping %s, already completed...' % name)
+        return
+    with phase(name):
+        func(ctx)
+        checkpoint(name)
+    ctx.completed.add(name)
+
+
+def checkpoint(name):
+    # Queued last in the phase's chroot commands, so it only runs if
+    # everything before it succeeded
+    chroot('mkdir -p {0} && touch {1} && {2}'.format(
+        os.path.dirname(state_file), state_file, render.line_command(state_file, name)))
+
+
+def phases_conflict(first, second):
+    if first not in phase_resources or second not in phase_resources:
+        return True
+    reads, writes = phase_resources[first]
+    other_reads, other_writes = phase_resources[second]
+    return bool(set(writes) & set(other_reads + other_writes) or
+                set(other_writes) & set(reads))
+
+
+def schedule_phases(phases):
+    """
+    Group phases into waves whose phases can run at the same time. Each
+    phase goes in the wave after the last earlier phase it conflicts with,
+    so phases sharing a resource still run in their original order.
+    """
+    waves = []
+    levels = {}
+    for index, (name, func) in enumerate(phases):
+        level = max([levels[other] + 1 for other, _ in phases[:index]
+                     if phases_conflict(other, name)] or [0])
+        levels[name] = level
+        if level == len(waves):
+            waves.append([])
+        waves[level].append((name, func))
+    return waves
+
+
+def run_phases(phases):
+    """
+    Run the phases of the install, those that are independent of each other
+    at the same time unless ctx.concurrent is off.
+    """
+    ctx = context()
+    if not ctx.concurrent:
+        for name, func in phases:
+            run_phase(name, func)
+        return
+    for name, _ in phases:
+        if name in ctx.completed:
+            log('Skipping %s, already completed...' % name)
+    for wave in schedule_phases([(name, func) for name, func in phases
+                                 if name not in ctx.completed]):
+        if len(wave) == 1:
+            run_phase(*wave[0])
+        else:
+            run_concurrent(wave)
+
+
+def run_concurrent(phases):
+    """
+    Run independent phases at the same time. The chroot commands of each
+    phase are collected as a job, and the jobs run side by side in a single
+    arch-chroot session. Anything a phase runs straight away, such as
+    pacman or commands on the host, runs while the jobs are collected.
+    """
+    ctx = context()
+    names = [name for name, _ in phases]
+    log('Running %s at the same time...' % ', '.join(names))
+    if ctx.script is not None:
+        for name in names:
+            ctx.script.append(('event', 'phase-start %s' % name, False))
+    jobs = []
+    with traced(' + '.join(names), 'phase'):
+        for name, func in phases:
+            start = time.time()
+            ctx.current_phase = name
+            ctx.chroot_queue = []
+            try:
+                func(ctx)
+                checkpoint(name)
+                jobs.append((name, ctx.chroot_queue, time.time() - start))
+            finally:
+                ctx.chroot_queue = None
+        run_chroot_jobs(jobs)
+    if ctx.script is not None:
+        for name in names:
+            ctx.script.append(('event', 'phase-end %s' % name, False))
+    ctx.completed.update(names)
+
+
+def run_chroot_jobs(jobs):
+    """
+    Run (name, commands, seconds) jobs at the same time inside the target.
+    The output of each job is written to the install log separately, and the
+    first failing job aborts the install with its own output.
+    """
+    ctx = context()
+    job_dir = '/var/tmp/chroot-jobs'
+    script = upload_files()
+    script += 'rm -rf {0}{1} && mkdir -p {0}{1}\n'.format(ctx.dest, job_dir)
+    script += "cat <<'EOF' > {0}{1}/run.sh\n{2}EOF\n".format(ctx.dest, job_dir, chroot_jobs_script)
+    for index, (name, commands, _) in enumerate(jobs):
+        script += 'mkdir {0}{1}/{2:02d}\n'.format(ctx.dest, job_dir, index)
+        for step, command in enumerate(commands):
+            script += """cat <<CHROOTEOF > {0}{1}/{2:02d}/{3:03d}
+#!/bin/bash -ex
+{4}
+CHROOTEOF
+""".format(ctx.dest, job_dir, index, step, command)
+    sudo(script)
+    start = time.time()
+    out = sudo('arch-chroot {0} bash {1}/run.sh {1}'.format(ctx.dest, job_dir),
+               warn_only=ctx.script is None)
+    failed = None
+    for match in re.finditer(r'^chroot-job: begin (\d+)\r?\n(.*?)^chroot-job: end \1 (\d+) (\d+)\r?$',
+                             out, re.MULTILINE | re.DOTALL):
+        index, return_code = int(match.group(1)), int(match.group(3))
+        name, commands, collected = jobs[index]
+        output, seconds = match.group(2).strip(), int(match.group(4)) / 1000.0
+        ctx.phases.append((name, collected + seconds))
+        ctx.trace.append({
+            'name': name, 'cat': 'phase', 'ph': 'X', 'pid': 1, 'tid': index + 2,
+            'ts': int((start - ctx.start) * 1e6), 'dur': int(seconds * 1e6),
+            'args': {'exit_code': return_code}})
+        if ctx.log_path:
+            with open(ctx.log_path, 'a') as f:
+                f.write(ctx.redact('--- {0} ---\n{1}\n'.format(name, output)))
+        if return_code and not failed:
+            failed = (name, commands, return_code, output)
+    if failed:
+        name, commands, return_code, output = failed
+        step = re.search('^chroot-batch: failed (\d+)', output, re.MULTILINE)
+        if not step:
+            abort('{0} failed:\n{1}'.format(name, output))
+        output = output.split('chroot-batch: start %s' % step.group(1))[-1]
+        output = output.split('chroot-batch: failed %s' % step.group(1))[0].strip()
+        abort(redact('{0}: chroot command failed with exit code {1}: {2}\n{3}'.format(
+            name, return_code, commands[int(step.group(1))].strip(), output)))
+    if out.failed:
+        abort('Concurrent chroot jobs failed:\n%s' % out)
 
 
 @task
 def install_os(fqdn, target, username=None, password=None, gui=False, kernel='',
                ssh_key='~/.ssh/id_rsa.pub', efi='auto', gpu='auto', extra_packages=None,
-               remote='auto', verbose=False):
+               remote=True, verbose=False, log_dir='logs', resume=False, compiled=False,
+               image=None, package_cache=False, cache_dir='~/.cache/fabulous/packages',
+               cache_size='20G', cache_port=8879, mirror='https://mirrors.kernel.org/archlinux',
+               prefetch=True, prefetch_workers=4, concurrent=True, size='8G',
+               compress=True, fs_profile='default', tuning_profile='auto',
+               tuning_overrides=None, rank_mirrors=False, mirror_candidates=None,
+               mirror_count=5, mirror_ttl=21600, mirrorlist=None, parallel_downloads=5,
+               refresh_facts=False, facts_ttl=86400, facts_file=None, bundle=None,
+               profile=None, fast_boot=False, boot_report=False):
     """
-    If specified, gpu must be one of: nvidia, nouveau, amd, intel or vbox.
+    If specified, gpu must be one of: nvidia, nouveau, amd, intel, vbox,
+    vmware, qxl or generic.
 
     If password is specified it will be set as the root password on the
     machine. Otherwise a random password will be set for security purposes.
@@ -462,13 +1960,108 @@ def install_os(fqdn, target, username=None, password=None, gui=False, kernel='',
     If username is set, the user will be created with sudo access, and the provided
     password will be used for the user instead of root.
 
-    gpu: Should be one of: auto, nvidia, nouveau, ati, intel, vbox. Default is auto.
+    gpu: Should be one of: auto, nvidia, nouveau, amd, intel, vbox, vmware, qxl or
+        generic. Default is auto.
     gui: Will configure a basic gnome environment (true/false, Default is false)
+    profile: Role profile in fabfile/profiles naming the packages and
+        services to install, e.g. base, workstation, build-node or vm-guest.
+        Default is workstation if gui is set and base otherwise. A role's
+        own tuning_profile is used unless one is given. Fabric keeps role=
+        for itself, hence the name.
     kernel: Can be 'lts', 'grsec', or other kernels in the repositories. Default is vanilla.
-    remote: Set if not building locally to abachi. Should be auto detected if not set.
+    remote: Use the target's package cache rather than the host's during
+        pacstrap (true/false, Default is true).
+    log_dir: Directory to write the install log and its timing trace to. The
+        trace is in Chrome's trace event format, viewable in chrome://tracing.
+    resume: Continue a failed install on the same target (true/false, Default
+        is false). The device is mounted again instead of being repartitioned,
+        and phases already recorded in /var/lib/fabulous are skipped.
+    compiled: Upload the whole install as one script and run it in a single
+        command, instead of running each command separately. Best for
+        high-latency links (true/false, Default is false).
+    image: Local path of a base image made by build_image. Only the phases
+        specific to this machine are run on top of it. Requires a device target.
+    package_cache: Serve packages to the target through a caching proxy on
+        this machine, tunnelled over ssh (true/false, Default is false).
+        Packages are kept in cache_dir, up to cache_size, and fetched from
+        mirror on a miss. cache_port is used on both ends of the tunnel.
+    prefetch: Download every package of the install up front, with
+        prefetch_workers downloads at once, while the earlier phases run
+        (true/false, Default is true).
+    concurrent: Run phases that do not touch the same files at the same time
+        inside the chroot, each with its own output in the log (true/false,
+        Default is true).
+    extra_packages: Space separated packages to install as well.
+
+    image and bundle paths may contain {role} and {hash}, replaced by the
+    role's name and the hash of its resolved packages and services together
+    with gpu, kernel and extra_packages, so that every host of a role finds
+    the artifacts built for it with the same options. gpu only counts for a
+    GUI role, and must be given as it was to build_image.
+
+    target can also be image:PATH, to install onto a disk image at PATH on
+    the host instead of a device. The image is created sparse with the given
+    size (Default is 8G) if it does not exist yet, and attached to a loop
+    device for the install. When compress is set the finished image is also
+    saved compressed as PATH.zst (true/false, Default is true).
+
+    target can also be several devices joined with +, e.g. /dev/sda+/dev/sdb,
+    to install onto a btrfs RAID1 across all of them. Each disk is
+    partitioned alike, and the first holds the boot partition. Disks that
+    support discard are discarded whole before they are partitioned.
+
+    fs_profile: btrfs layout and mount options for a device target. One of
+        default, throughput, ssd or vm. Every profile but default mounts
+        with noatime, zstd compression and space_cache=v2, and splits the
+        package cache (nodatacow), /var/log and /home into their own
+        subvolumes. ssd and vm also discard freed blocks asynchronously.
+    tuning_profile: Kernel and I/O tuning written for the machine. One of
+        auto, server, desktop, laptop, vm or none. auto picks one from the
+        detected hardware. Writeback limits, zram swap, I/O schedulers and
+        the CPU governor are then scaled to its memory, CPUs and disk. The
+        choices and their reasons are logged and saved to
+        /etc/fabulous/tuning.json on the machine.
+    tuning_overrides: Space separated key=value settings taking precedence
+        over the tuning, e.g. 'vm.swappiness=10 governor=powersave zram=0'.
+        zram is in MiB.
+    rank_mirrors: Time the mirrors in mirror_candidates (space separated,
+        Default is a list of well known ones) all at once from this machine,
+        and install from the mirror_count fastest. The ranking is cached for
+        mirror_ttl seconds (Default is 6 hours), so a fleet ranks them once.
+        They replace the mirrorlist on the host and in the install, and are
+        the package cache's upstreams. As the mirrors are timed from here
+        and not from the host, only use it when both are on the same network
+        (true/false, Default is false).
+    mirrorlist: Space separated mirror URLs to install from in this order,
+        e.g. one on the local network, instead of ranking them. They are
+        written to the mirrorlist on the host and in the install as they are.
+    parallel_downloads: Packages pacman downloads at once, on the host and
+        in the install. 0 leaves pacman.conf alone. Default is 5.
+    refresh_facts: Collect the host's hardware facts again even if they are
+        cached (true/false, Default is false). Cached facts are used for up
+        to facts_ttl seconds (Default is a day), unless the host rebooted.
+    facts_file: Local JSON file of facts to make the install's decisions
+        from instead of the host's own, e.g. as written by show_facts.
+    bundle: Local offline bundle made by build_bundle to install every
+        package from, without network access. It is uploaded to the host
+        unless the host has it already. Mirrors are neither ranked nor used,
+        nothing is prefetched and the timezone is set to UTC, as tzupdate
+        needs to look it up online. Cannot be combined with package_cache.
+    fast_boot: Shorten the boot of the machine according to its tuning
+        profile (true/false, Default is false). The systemd-boot menu is
+        hidden, the initramfs compressed with lz4, or zstd on rotational
+        disks, services with a socket such as docker started on first use
+        (avahi-daemon always starts, for mDNS announcements), and desktops
+        and laptops stop waiting for the network. The choices and their
+        reasons are logged and saved to /etc/fabulous/boot.json.
+    boot_report: Time the first boot of the machine with systemd-analyze
+        (true/false, Default is false). show_boot_report fetches the result.
     """
+    ctx = new_context()
     device = None
     mountpoint = None
+    disk_image = None
+    loop_device = None
     ssh_key_path = os.path.expanduser(ssh_key)
 
     if ssh_key == '~/.ssh/id_rsa.pub' and not os.path.isfile(ssh_key_path):
@@ -479,160 +2072,630 @@ def install_os(fqdn, target, username=None, password=None, gui=False, kernel='',
 
     gui = booleanize(gui)
     verbose = booleanize(verbose)
+    resume = booleanize(resume)
+    compiled = booleanize(compiled)
+    remote = booleanize(remote)
+    package_cache = booleanize(package_cache)
+    prefetch = booleanize(prefetch)
+    compress = booleanize(compress)
+    if isinstance(extra_packages, basestring):
+        extra_packages = extra_packages.split()
     hide_settings = ['running', 'output']
 
     if verbose:
         hide_settings = []
 
-    with hide(*hide_settings):
-        # Sanity checks
-        if not fqdn:
-            raise RuntimeError("You must specify an fqdn!")
-        shortname = get_shortname(fqdn)
-
-        if gpu not in valid_gpus:
-            raise RuntimeError("Invalid gpu specified")
-
-        if ssh_key and not os.path.isfile(ssh_key):
-            raise RuntimeError("The specified SSH key cannot be found!")
-
-        # Auto-detection
-        # TODO: Split in to different functions
-        if sudo('test -b %s' % target, quiet=True).succeeded:
-            device = target
-        elif sudo('test -d %s' % target, quiet=True).succeeded:
-            if sudo('mount | grep -q %s' % target, quiet=True).succeeded:
-                mountpoint = target
-
-        if not device and not mountpoint or device and mountpoint:
-            raise RuntimeError("Target is neither a device nor a mount point. Aborting")
-
-        if remote is 'auto':
-            # Auto detect if we are remote or not. Copied from facter fact
-            remote = True
-            if sudo("nslookup abachi.dray.be | grep -o '192.168.1.15'", quiet=True) == '192.168.1.15':
-                if sudo("ip route|grep default|grep -o 192.168.1.1", quiet=True) == '192.168.1.1':
-                    remote = False
-
-        if efi is 'auto':
-            if sudo('efibootmgr &>/dev/null', quiet=True).succeeded:
-                efi = True
+    try:
+        with hide(*hide_settings):
+            # Sanity checks
+            if not fqdn:
+                raise RuntimeError("You must specify an fqdn!")
+            shortname = get_shortname(fqdn)
+            ctx.open_log(log_dir, shortname)
+
+            if gpu not in valid_gpus:
+                raise RuntimeError("Invalid gpu specified")
+
+            if fs_profile not in fs_profiles:
+                raise RuntimeError("Invalid fs_profile specified")
+
+            if tuning_profile not in tuning.profiles:
+                raise RuntimeError("Invalid tuning_profile specified")
+
+            try:
+                tuning.parse_overrides(tuning_overrides)
+            except ValueError as e:
+                abort(str(e))
+
+            select_role(ctx, profile, gui)
+            if tuning_profile == 'auto':
+                tuning_profile = ctx.role['tuning_profile']
+
+            if bundle:
+                bundle = roles.artifact_path(bundle, ctx.role, gpu=gpu, kernel=kernel,
+                                              extra_packages=extra_packages)
+                if not os.path.isfile(bundle):
+                    raise RuntimeError("The specified bundle cannot be found!")
+                if package_cache:
+                    raise RuntimeError("A bundle cannot be used with the package cache")
+
+            if ssh_key and not os.path.isfile(ssh_key):
+                raise RuntimeError("The specified SSH key cannot be found!")
+
+            if image:
+                image = roles.artifact_path(image, ctx.role, gpu=gpu, kernel=kernel,
+                                             extra_packages=extra_packages)
+                if not os.path.isfile(image):
+                    raise RuntimeError("The specified image cannot be found!")
+                if compiled:
+                    raise RuntimeError("Images cannot be used with a compiled install")
+
+            connect()
+
+            if target.startswith('image:'):
+                disk_image = target[len('image:'):]
+                loop_device = target = attach_disk_image(disk_image, size)
+
+            devices = target.split('+')
+            # Auto-detection, with every probe in a single round trip
+            results, ctx.facts = collect_facts({
+                'device': ' && '.join('test -b %s' % device for device in devices),
+                'directory': 'test -d %s' % target,
+                'mounted': 'mount | grep -q %s' % target,
+                'mountpoint': "mount | grep -qE '\\s%s\\s+type'" % target,
+                'label': root_label_command(target),
+                'disk': facts.target_disk_command(devices[0]),
+            }, booleanize(refresh_facts), facts_ttl, facts_file)
+            log('%s facts of the host' % ('Using cached' if ctx.facts['cached'] else 'Collected'))
+            if results['device'].succeeded:
+                device = devices[0]
+                ctx.devices = devices
+            elif results['directory'].succeeded:
+                if results['mounted'].succeeded:
+                    mountpoint = target
+
+            if not device and not mountpoint or device and mountpoint:
+                raise RuntimeError("Target is neither a device nor a mount point. Aborting")
+
+            if image and not device:
+                raise RuntimeError("Installing from an image requires a device target")
+
+            if efi == 'auto':
+                efi = ctx.facts['efi']
+            efi = booleanize(efi)
+
+            ctx.fqdn = fqdn
+            ctx.device = device
+            ctx.disk = facts.parse_target_disk(results['disk'])
+            ctx.username = username
+            ctx.password = password
+            ctx.ssh_key = ssh_key
+            ctx.gpu = gpu
+            ctx.kernel = kernel
+            ctx.efi = efi
+            ctx.remote = remote
+            ctx.extra_packages = extra_packages
+            ctx.image = image
+            ctx.package_cache = package_cache
+            ctx.cache_port = int(cache_port)
+            ctx.prefetch_workers = int(prefetch_workers)
+            ctx.concurrent = booleanize(concurrent)
+            ctx.fs_profile = fs_profile
+            ctx.tuning_profile = tuning_profile
+            ctx.tuning_overrides = tuning_overrides
+            ctx.fast_boot = booleanize(fast_boot)
+            ctx.boot_report = booleanize(boot_report)
+            if mirrorlist and not bundle:
+                ctx.mirrors = mirrorlist.split()
             else:
-                efi = False
-        efi = booleanize(efi)
-
-        if device:
-            if sudo('test -b %s' % device, quiet=True).return_code != 0:
-                raise RuntimeError("The device specified is not a device!")
+                ctx.mirrors = select_mirrors(booleanize(rank_mirrors) and not bundle,
+                                             mirror_candidates, mirror_count, mirror_ttl)
+            ctx.parallel_downloads = int(parallel_downloads)
+            detect_hardware(ctx)
+            if bundle:
+                upload_bundle(ctx, bundle)
 
-            env.dest = sudo('mktemp -d', quiet=True)
-
-            log('Preparing device...')
-            prepare_device(device, shortname, efi)
-        elif mountpoint:
-            env.dest = mountpoint
-            mounts = sudo('mount', quiet=True)
-            if not re.search('\s%s\s+type' % env.dest, mounts):
-                raise RuntimeError("The specified mountpoint is not mounted")
-
-        try:
-            log('Enabling dray.be repo during install...')
-            enable_dray_repo('host')
-
-            log('Enabling multilib repo during install...')
-            enable_multilib_repo('host')
-
-            log('Enabling mDNS during install...')
-            enable_mdns('host')
-
-            if not remote:
-                log('Mounting package cache...')
-                out = sudo('mount -t nfs abachi.local:/pacman /var/cache/pacman/pkg', quiet=True)
-                if out.return_code not in {32, 0}:
-                    print("Failed to mount package cache. Aborting")
-                    sys.exit(1)
-
-            log('Installing base OS (may take a few minutes)...')
-            pacman(['base'], pacstrap=True, remote=remote)
+            if device:
+                ctx.dest = sudo('mktemp -d', quiet=True)
+                ctx.root_label = '%s-btrfs' % shortname
+
+                if resume:
+                    with phase('mount device'):
+                        log('Mounting existing install...')
+                        mount_device(device)
+                else:
+                    if compiled:
+                        ctx.script = []
+                    with phase('prepare device'):
+                        log('Preparing device...')
+                        prepare_device(ctx.devices, shortname, efi, image)
+            elif mountpoint:
+                ctx.dest = mountpoint
+                if results['mountpoint'].failed:
+                    raise RuntimeError("The specified mountpoint is not mounted")
+                ctx.root_label = results['label']
+
+            try:
+                if resume or image:
+                    # Images record the phases they were built with
+                    ctx.completed = load_checkpoints()
+                    if ctx.completed:
+                        log('Resuming install, completed phases: %s' % ', '.join(sorted(ctx.completed)))
+
+                with serve_package_cache(ctx, cache_dir, cache_size, mirror):
+                    if compiled and ctx.script is None:
+                        ctx.script = []
+
+                    with phase('host setup'):
+                        setup_host(ctx)
+                        # An image already holds nearly every package, and
+                        # a bundle all of them
+                        if prefetch and not image and not ctx.bundle:
+                            start_prefetch(ctx)
+
+                    if 'pacstrap' in ctx.completed:
+                        configure_chroot_mirrors(ctx)
+
+                    run_phases(install_phases(ctx))
+
+                    if ctx.script is not None:
+                        run_compiled_script(ctx)
+
+                log('Success!')
+
+            finally:
+                ctx.script = None
+                if ctx.bundle:
+                    restore_host_pacman_conf()
+                if disk_image:
+                    trim_disk_image()
+                if device:
+                    cleanup(ctx.devices)
+
+            if disk_image and compress:
+                compress_disk_image(disk_image)
+    finally:
+        if loop_device:
+            sudo('losetup -d %s' % loop_device, quiet=True)
+        ctx.write_trace()
+
+    return ctx.summary()
 
-            if not remote:
-                log('Mounting package cache in chroot...')
-                out = sudo('mount -t nfs abachi.local:/pacman %s/var/cache/pacman/pkg' % env.dest, quiet=True)
-                if out.return_code not in {32, 0}:
-                    print("Failed to mount package cache. Aborting")
-                    sys.exit(1)
 
-            log('Enabling dray.be repo...')
-            enable_dray_repo('chroot')
+@task
+def build_image(image, scratch='/var/lib/fabulous/images', gui=False, gpu='auto',
+                kernel='', extra_packages=None, remote=True, verbose=False,
+                log_dir='logs', level=3, profile=None):
+    """
+    Builds the parts of an install that are common to every machine into a
+    btrfs subvolume under scratch, which must be on btrfs, and saves it as a
+    zstd compressed btrfs send stream at the local path image. Use it with
+    install_os:image=... to only run the per-machine phases.
+
+    The read-only reference subvolume is kept at scratch/base.
+    gpu must be given explicitly when gui is set, as the build host's GPU
+    says nothing about the machines the image is for.
+    level: zstd compression level. Default is 3.
+    profile: Role profile of the image, as for install_os. image may contain
+        {role} and {hash}, e.g. ~/images/{role}-{hash}.zst. The hash also
+        covers gpu, kernel and extra_packages.
+    """
+    ctx = new_context()
+    gui = booleanize(gui)
+    verbose = booleanize(verbose)
+    hide_settings = [] if verbose else ['running', 'output']
+
+    if gpu not in valid_gpus:
+        raise RuntimeError("Invalid gpu specified")
+    if isinstance(extra_packages, basestring):
+        extra_packages = extra_packages.split()
+
+    ctx.open_log(log_dir, 'image')
+    select_role(ctx, profile, gui)
+    if ctx.gui and gpu == 'auto':
+        raise RuntimeError("A gpu must be specified for a GUI image")
+    image = roles.artifact_path(image, ctx.role, gpu=gpu, kernel=kernel,
+                                extra_packages=extra_packages)
+    ctx.gpu = gpu
+    ctx.kernel = kernel
+    ctx.extra_packages = extra_packages
+    ctx.remote = booleanize(remote)
+    # The image is planned as for a BIOS machine without microcode. The boot
+    # loader phase of each host installed from it adds what the host needs
+    ctx.laptop = False
+    ctx.intel = False
+    ctx.efi = False
+    build = '%s/base-build' % scratch
+    ctx.dest = build
+    remote_image = '/var/tmp/fabulous-base.img.zst'
 
-            log('Enabling multilib repo...')
-            enable_multilib_repo('chroot')
+    try:
+        with hide(*hide_settings):
+            connect()
+            sudo('mkdir -p "%s"' % scratch)
+            sudo('btrfs subvolume delete "{0}" "{1}/base"'.format(build, scratch), quiet=True)
+            sudo('btrfs subvolume create "%s"' % build)
+            # pacstrap and arch-chroot expect the target to be a mountpoint
+            sudo('mount --bind "{0}" "{0}"'.format(build))
+            try:
+                with phase('host setup'):
+                    setup_host(ctx)
+                run_phases([(name, func) for name, func in install_phases(ctx)
+                            if name not in host_phases])
+
+                with phase('export'):
+                    log('Cleaning up image...')
+                    chroot('rm -rf /var/cache/pacman/pkg/* && truncate -s 0 /etc/machine-id')
+            finally:
+                sudo('umount -R "%s"' % build, quiet=True)
+
+            log('Exporting image...')
+            sudo('btrfs subvolume snapshot -r "{0}" "{1}/base"'.format(build, scratch))
+            sudo('btrfs subvolume delete "%s"' % build)
+            sudo('btrfs send "{0}/base" | zstd -T0 -{1} > {2}'.format(
+                scratch, int(level), remote_image))
+            executor.current().get(remote_image, image)
+            sudo('rm -f %s' % remote_image)
+            log('Image saved to %s' % image)
+    finally:
+        ctx.write_trace()
 
-            log('Installing additional base packages (may take a few minutes)...')
-            pacman(base_packages)
 
-            log('Configuring sudo...')
-            configure_sudo()
+@task
+def build_bundle(bundle, gui=False, gpu='auto', kernel='', extra_packages=None,
+                 scratch='/var/tmp/fabulous-bundle-build', workers=4, verbose=False,
+                 log_dir='logs', profile=None):
+    """
+    Downloads every package an install with the given gui, gpu, kernel and
+    extra_packages needs, down to the last dependency, on the host, and
+    saves them with a repository database as an offline bundle at the local
+    path bundle. Use it with install_os:bundle=... to install without
+    network access.
+
+    The host needs network access, this machine does not. Microcode and the
+    BIOS boot loader are always included, as are the drivers of every GPU
+    when gui is set and gpu is auto, so that the bundle fits any machine.
+    workers: Packages downloaded at once. Default is 4.
+    profile: Role profile of the bundle, as for install_os. bundle may contain
+        {role} and {hash}, which also covers gpu, kernel and extra_packages.
+    """
+    ctx = new_context()
+    gui = booleanize(gui)
+    verbose = booleanize(verbose)
+    hide_settings = [] if verbose else ['running', 'output']
+    if gpu not in valid_gpus:
+        raise RuntimeError("Invalid gpu specified")
+    if isinstance(extra_packages, basestring):
+        extra_packages = extra_packages.split()
+
+    ctx.open_log(log_dir, 'bundle')
+    select_role(ctx, profile, gui)
+    bundle = roles.artifact_path(bundle, ctx.role, gpu=gpu, kernel=kernel,
+                                 extra_packages=extra_packages)
+    ctx.gpu = gpu
+    ctx.kernel = kernel
+    ctx.extra_packages = extra_packages
+    ctx.laptop = True
+    ctx.intel = True
+    ctx.efi = False
+    packages = ['base'] + [package for _, planned in plan_packages(ctx) for package in planned]
+    keys = []
+    if ctx.gui:
+        packages += infinality_packages
+        keys.append(infinality_key)
+        if gpu == 'auto':
+            packages += [package for drivers in gpu_packages.values() for package in drivers]
+    manifest = offline.manifest(
+        {'role': ctx.role['name'], 'role_hash': ctx.role['hash'],
+         'hash': roles.artifact_hash(ctx.role, gpu, kernel, extra_packages),
+         'gui': ctx.gui, 'gpu': gpu, 'kernel': kernel, 'extra_packages': extra_packages or []},
+        packages)
+    build = scratch.rstrip('/')
 
-            if not password:
-                password = generate_password(16)
+    try:
+        with hide(*hide_settings):
+            connect()
+            with phase('host setup'):
+                enable_dray_repo('host')
+                enable_multilib_repo('host')
+                if ctx.gui:
+                    enable_infinality_repo('host')
+
+            with phase('download'):
+                log('Downloading %d packages and their dependencies...' % len(manifest['packages']))
+                sudo("""rm -rf {0} {0}.tar && mkdir -p {0}
+cat <<'EOF' > {0}.sh
+{1}EOF
+cat <<'EOF' > {0}/pacman.conf
+{2}EOF
+cat <<'EOF' > {0}/manifest.json
+{3}
+EOF""".format(build, offline.build_script, offline.pacman_conf(), json.dumps(manifest, indent=1)))
+                out = sudo('bash {0}.sh {0} {1} {2} "{3}" {4}'.format(
+                    build, int(workers), dray_repo_package, ' '.join(keys),
+                    ' '.join(manifest['packages'])))
+                log('Downloaded %s' % out.strip().split('\n')[-1])
+
+            with phase('export'):
+                executor.current().get(build + '.tar', bundle)
+                sudo('rm -rf {0} {0}.tar {0}.sh'.format(build))
+                log('Bundle %s saved to %s' % (manifest['id'], bundle))
+    finally:
+        ctx.write_trace()
+
+
+def format_duration(seconds):
+    return '%dm%02ds' % divmod(int(round(seconds)), 60)
+
+
+def print_fleet_summary(summaries):
+    phases = []
+    for summary in summaries:
+        for name, _ in summary['phases']:
+            if name not in phases:
+                phases.append(name)
+    header = ['host', 'status', 'total'] + phases
+    rows = []
+    for summary in sorted(summaries, key=lambda s: s['host']):
+        timings = dict(summary['phases'])
+        row = [summary['host'], 'failed' if summary['error'] else 'ok',
+               format_duration(summary['total'])]
+        row += [format_duration(timings[name]) if name in timings else '-'
+                for name in phases]
+        rows.append(row)
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    for row in [header] + rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+    for summary in summaries:
+        if summary['error']:
+            print('{0}: {1}'.format(summary['host'], summary['error']))
+
+
+def install_host(fqdn, **kwargs):
+    """
+    Run install_os against the current host, returning its summary rather
+    than aborting the other hosts of the fleet when it fails.
+    """
+    start = time.time()
+    error = None
+    try:
+        install_os(fqdn.format(host=env.host), **kwargs)
+    except (Exception, SystemExit) as e:
+        error = str(e) or e.__class__.__name__
+    if env.host_string in _contexts:
+        summary = context().summary()
+    else:
+        summary = {'host': env.host_string, 'phases': []}
+    summary.update(error=error, total=time.time() - start)
+    return summary
 
-            root_password = password
 
-            if username:
-                log('Creating user %s...' % username)
-                chroot('useradd -m %s -G wheel' % username)
-                log('Setting %s account password...' % username)
-                chroot("echo '{0}:{1}' | chpasswd".format(username, password))
-                root_password = generate_password(16)
-            else:
-                username = 'root'
+@task
+def show_facts(refresh=False, output=None):
+    """
+    Prints the hardware facts of the host that installs make their decisions
+    from, collecting them again if refresh is set or they are not cached.
 
-            log('Setting root password...')
-            chroot("echo 'root:{0}' | chpasswd".format(root_password))
+    output: Also write them to this local JSON file, which install_os takes
+        as facts_file.
+    """
+    _, host_facts = collect_facts({}, booleanize(refresh))
+    print(facts.report(host_facts))
+    if output:
+        with open(os.path.expanduser(output), 'w') as f:
+            f.write(facts.report(host_facts))
 
-            if ssh_key:
-                log('Installing ssh key...')
-                install_ssh_key(ssh_key, username)
 
-            log('Configuring network...')
-            network_config(fqdn)
+@task
+def show_boot_report(output=None):
+    """
+    Prints how long the first boot of a machine installed with boot_report
+    took, its critical chain and its slowest units, from the report the
+    machine wrote once it had booted.
 
-            log('Configuring mDNS...')
-            enable_mdns('chroot')
+    output: Also write them to this local JSON file.
+    """
+    out = sudo('cat %s' % boottime.report_path, quiet=True)
+    if out.failed:
+        abort('No boot report on %s yet, it is written once the first boot finishes' %
+              env.host_string)
+    report = boottime.parse_report(out)
+    print(' + '.join('%s %.2fs' % (stage, report['times'][stage]) for stage in boottime.stages
+                     if stage in report['times']))
+    print('Total %.2fs' % report['times'].get('total', 0))
+    print(report['critical_chain'])
+    for unit, seconds in report['blame'][:10]:
+        print('{0:>8.3f}s {1}'.format(seconds, unit))
+    if output:
+        with open(os.path.expanduser(output), 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
 
-            log('Configuring base system services...')
-            enable_services(base_services)
 
-            log('Generating fstab...')
-            generate_fstab(fqdn, device)
+@task
+@runs_once
+def install_fleet(pool_size=4, fqdn='{host}', **kwargs):
+    """
+    Runs install_os against every host given with -H in parallel, with at
+    most pool_size installs running at once, then prints the result and
+    per-phase timings of each host.
 
-            log('Setting up cron jobs...')
-            create_cron_job('create-package-list', 'pacman -Qe > /etc/package-list', time='daily')
-            create_cron_job('udpate-pkgfile', 'pkgfile -u &>/dev/null', time='daily')
+    fqdn is formatted with the host name, e.g. fqdn={host}.example.com.
+    Defaults to the host name. All other arguments are passed to install_os.
+    """
+    env.fleet = True
+    # Every host shares the package cache served from this process
+    started = False
+    # Ranked once here, every host then finds the ranking in the cache
+    if kwargs.get('mirrorlist'):
+        upstreams = kwargs['mirrorlist'].split()
+    else:
+        upstreams = select_mirrors(
+            booleanize(kwargs.get('rank_mirrors', False)), kwargs.get('mirror_candidates'),
+            kwargs.get('mirror_count', 5), kwargs.get('mirror_ttl', 21600))
+    if booleanize(kwargs.get('package_cache', False)):
+        started = pkgcache.start(
+            kwargs.get('cache_dir', '~/.cache/fabulous/packages'), kwargs.get('cache_size', '20G'),
+            upstreams or [kwargs.get('mirror', 'https://mirrors.kernel.org/archlinux')],
+            kwargs.get('cache_port', 8879))
+    try:
+        results = execute(parallel(pool_size=int(pool_size))(install_host),
+                          fqdn=fqdn, **kwargs)
+    finally:
+        if started:
+            print('Package cache: %s' % pkgcache.format_stats(pkgcache.stop()))
+    print_fleet_summary(results.values())
+    failed = [host for host, summary in results.items() if summary['error']]
+    if failed:
+        abort('Install failed on: %s' % ', '.join(sorted(failed)))
 
-            log('Setting default locale...')
-            set_locale()
 
-            log('Setting default timezone...')
-            set_timezone()
+@task
+def record_install(responses, fqdn, target, **kwargs):
+    """
+    Runs install_os and saves the output of every command it ran to the
+    local JSON file responses, for simulate to replay. Commands are saved by
+    their hash only, so the file holds none of the passwords they set. All
+    other arguments are passed to install_os.
+    """
+    recorder = executor.RecordingExecutor(executor.current())
+    try:
+        with executor.use(recorder):
+            return install_os(fqdn, target, **kwargs)
+    finally:
+        recorder.save(os.path.expanduser(responses))
 
-            if gui:
-                gpu_install(gpu)
-                gui_install()
 
-            log('Configuring settings...')
-            configure_settings()
+@task
+def simulate(fqdn='sim.example.com', target='/dev/sda', responses=None,
+             max_round_trips=None, output=None, **kwargs):
+    """
+    Runs install_os against canned command outputs instead of a host, and
+    prints the remote round trips and bytes the install took. Nothing is
+    run remotely.
+
+    responses: JSON file saved by record_install. Its outputs are replayed
+        in order for each command before the built-in canned outputs.
+    max_round_trips: Fail if the install takes more round trips than this.
+    output: Also write the statistics to this local JSON file.
+    All other arguments are passed to install_os. With package_cache the
+    proxy is neither started nor tunnelled, only its commands are counted.
+    """
+    backend = executor.ReplayExecutor(
+        executor.load_responses(responses) if responses else None)
+    # Ranking would time the real mirrors
+    kwargs.setdefault('rank_mirrors', False)
+    start = time.time()
+    with executor.use(backend):
+        summary = install_os(fqdn, target, **kwargs)
+    stats = backend.stats()
+    stats['seconds'] = time.time() - start
+    stats['phases'] = summary['phases']
+    print('Simulated install in {0:.2f}s: {1} round trips ({2}), '
+          '{3:.1f} KiB sent, {4:.1f} KiB received'.format(
+              stats['seconds'], stats['round_trips'],
+              ', '.join('%d %s' % (count, kind) for kind, count in sorted(stats['calls'].items())),
+              stats['bytes_sent'] / 1024.0, stats['bytes_received'] / 1024.0))
+    if output:
+        with open(os.path.expanduser(output), 'w') as f:
+            json.dump(stats, f, indent=1)
+    if max_round_trips is not None and stats['round_trips'] > int(max_round_trips):
+        abort('The install took {0} round trips, more than the {1} allowed'.format(
+            stats['round_trips'], max_round_trips))
+    return stats
+
+
+def benchmark_run(index, fqdn, image, size, log_dir, kwargs):
+    """
+    Install onto a fresh disk image at image on the host, and return the
+    phases and totals of the install as bench.summarize() takes them.
+    """
+    state_dir = '%s/%d' % (bench.bench_dir, index)
+    sudo('rm -f "{0}" && rm -rf {1} && mkdir -p {1} && touch {1}/running && echo 0 > {1}/peak\n'
+         "cat <<'EOF' > {1}/monitor.sh\n{2}EOF\n"
+         'nohup setsid bash {1}/monitor.sh {1} "{0}" > /dev/null 2>&1 < /dev/null &'.format(
+             image, state_dir, bench.monitor_script), pty=False)
+    received = int(sudo(bench.received_bytes_command, quiet=True) or 0)
+    counter = executor.CountingExecutor(executor.current())
+    start = time.time()
+    try:
+        with executor.use(counter):
+            summary = install_os(fqdn, 'image:%s' % image, size=size, compress=False,
+                                 log_dir=log_dir, **kwargs)
+        if kwargs.get('mirrorlist'):
+            check_mirrorlist(kwargs['mirrorlist'].split())
+    finally:
+        total = time.time() - start
+        out = sudo('{0}; rm {1}/running; sleep 1; cat {1}/peak; rm -rf {1} "{2}"'.format(
+            bench.received_bytes_command, state_dir, image), quiet=True).split()
+    stats = counter.stats()
+    return {'phases': summary['phases'], 'total': total, 'round_trips': stats['round_trips'],
+            'bytes_sent': stats['bytes_sent'], 'bytes_received': stats['bytes_received'],
+            'downloaded': int(out[0]) - received if out else 0,
+            'peak_disk': int(out[1]) if len(out) > 1 else 0}
+
+
+def check_mirrorlist(urls):
+    """
+    Abort unless the host's mirrorlist names urls and no other mirror, so
+    that a benchmark cannot quietly download from public mirrors.
+    """
+    listed = mirrors.servers(sudo('cat /etc/pacman.d/mirrorlist', quiet=True))
+    if listed != [url.rstrip('/') for url in urls]:
+        abort('The mirrorlist names %s instead of %s' % (
+            ', '.join(listed) or 'no mirror', ', '.join(urls)))
 
-            if extra_packages:
-                log('Installing additional packages...')
-                pacman(extra_packages)
 
-            log('Installing boot loader...')
-            boot_loader(efi=efi, kernel=kernel)
+@task
+def benchmark(runs=3, image='/var/tmp/fabulous-bench.img', size='8G', fqdn='bench.example.com',
+              mirror=None, output=None, baseline=None, log_dir='logs/bench', **kwargs):
+    """
+    Installs onto a throwaway disk image on the host runs times over, and
+    prints the median, minimum, maximum and standard deviation of each
+    phase and of the total time, the remote round trips and bytes, the
+    bytes the host downloaded and the most disk the install used. All other
+    arguments are passed to install_os, e.g. efi, kernel, gui or remote, so
+    that their effect on install speed can be measured.
+
+    image: Path of the disk image on the host, created sparse with size
+        (Default is 8G) for each run and removed after it.
+    mirror: URL of a package mirror, e.g. one on the local network, to
+        install from as the only entry of the mirrorlist. Downloads then
+        say little about the internet connection of the day. Each run
+        checks that the host's mirrorlist names only this mirror.
+    output: Local JSON file to save the results of every run and their
+        summary to.
+    baseline: Local JSON file saved by an earlier benchmark, to compare the
+        medians with, e.g. one made with an older version of this file.
+
+    Caches outside the image, such as the package cache proxy and the
+    host's own pacman cache with remote=false, are only cold for the first
+    run, which shows in the spread.
+    """
+    runs = int(runs)
+    if mirror:
+        kwargs.setdefault('mirrorlist', mirror)
+        kwargs.setdefault('mirror', mirror)
+    results = []
+    for index in range(runs):
+        log('Benchmark run %d of %d...' % (index + 1, runs))
+        results.append(benchmark_run(index, fqdn, image, size, log_dir, kwargs))
+        log('Run %d took %s' % (index + 1, format_duration(results[-1]['total'])))
+    summary = bench.summarize(results, dict(kwargs, runs=runs, size=size))
+    print(bench.report(summary))
+    if output:
+        bench.save(summary, os.path.expanduser(output))
+    if baseline:
+        print()
+        print(bench.comparison_report(bench.compare(
+            bench.load(os.path.expanduser(baseline)), summary)))
+    return summary
 
-            log('Success!')
 
-        finally:
-            if device:
-                cleanup(device)
+@task
+def compare_benchmarks(before, after):
+    """
+    Prints the medians of two local JSON files saved by benchmark side by
+    side, with the change of each.
+    """
+    print(bench.comparison_report(bench.compare(
+        bench.load(os.path.expanduser(before)), bench.load(os.path.expanduser(after)))))
@@ -0,0 +1,139 @@
+"""
+Summarises repeated installs for the benchmark task: the median of each
+phase, the total, the remote commands, the bytes transferred and the disk
+used, with their spread across runs, and compares two such summaries.
+"""
+from __future__ import print_function
+
+import json
+import math
+
+# Where the monitor of a run keeps its state on the host
+bench_dir = '/var/tmp/fabulous-bench'
+
+# Watches the install's disk image from the host while a run goes on, and
+# keeps the most it ever had allocated in $1/peak. Stops once $1/running is
+# removed. Allocated rather than apparent size, as the image is sparse
+monitor_script = r'''state=$1
+image=$2
+peak=0
+while [ -e "$state/running" ]; do
+    used=$(( $(stat -c '%b * %B' "$image" 2>/dev/null || echo 0) ))
+    if [ "$used" -gt "$peak" ]; then
+        peak=$used
+        echo $peak > "$state/peak"
+    fi
+    sleep 1
+done
+'''
+
+# Bytes the host has received on every interface but loopback, so that the
+# difference across a run is what it downloaded, packages and all
+received_bytes_command = "sed 's/:/ /' /proc/net/dev | awk 'NR > 2 && $1 != \"lo\" {sum += $2} END {print sum + 0}'"
+
+# Measures of a run other than its phases, and their units
+metrics = [
+    ('total', 's'),
+    ('round_trips', ''),
+    ('bytes_sent', 'B'),
+    ('bytes_received', 'B'),
+    ('downloaded', 'B'),
+    ('peak_disk', 'B'),
+]
+
+
+def spread(values):
+    """Return the median, minimum, maximum and standard deviation of values."""
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        median = values[middle]
+    else:
+        median = (values[middle - 1] + values[middle]) / 2.0
+    mean = sum(values) / float(len(values))
+    return {'median': median, 'min': values[0], 'max': values[-1],
+            'stdev': math.sqrt(sum((value - mean) ** 2 for value in values) / len(values))}
+
+
+def summarize(runs, options=None):
+    """
+    Return the summary of runs, each a dict of the metrics and a list of
+    (phase, seconds). Phases missing from some runs, such as those skipped
+    by a resume, are summarised over the runs that have them.
+    """
+    phases = []
+    for run in runs:
+        for name, _ in run['phases']:
+            if name not in phases:
+                phases.append(name)
+    return {
+        'options': options or {},
+        'runs': runs,
+        'metrics': dict((metric, spread([run[metric] for run in runs])) for metric, _ in metrics),
+        'phase_order': phases,
+        'phases': dict((name, spread([seconds for run in runs
+                                      for phase, seconds in run['phases'] if phase == name]))
+                       for name in phases),
+    }
+
+
+def format_value(value, unit):
+    if unit == 'B':
+        return '%.1fM' % (value / float(1 << 20))
+    if unit == 's':
+        return '%.1fs' % value
+    return '%d' % value
+
+
+def report(summary):
+    lines = ['{0:<24} {1:>10} {2:>10} {3:>10} {4:>8}'.format(
+        'phase', 'median', 'min', 'max', 'stdev')]
+    rows = [(name, summary['phases'][name], 's') for name in summary['phase_order']]
+    rows += [(metric, summary['metrics'][metric], unit) for metric, unit in metrics]
+    for name, values, unit in rows:
+        lines.append('{0:<24} {1:>10} {2:>10} {3:>10} {4:>8}'.format(
+            name, format_value(values['median'], unit), format_value(values['min'], unit),
+            format_value(values['max'], unit), format_value(values['stdev'], unit)))
+    return '\n'.join(lines)
+
+
+def compare(old, new):
+    """
+    Return the medians of old and new summaries side by side, as rows of
+    name, unit, old median, new median and the change in percent, or None
+    where either has no such phase.
+    """
+    rows = []
+    names = old['phase_order'] + [name for name in new['phase_order']
+                                  if name not in old['phase_order']]
+    for name in names:
+        before = old['phases'].get(name, {}).get('median')
+        after = new['phases'].get(name, {}).get('median')
+        rows.append((name, 's', before, after))
+    for metric, unit in metrics:
+        rows.append((metric, unit, old['metrics'][metric]['median'],
+                     new['metrics'][metric]['median']))
+    return [(name, unit, old_median, new_median,
+             (new_median - old_median) * 100.0 / old_median
+             if old_median and new_median is not None else None)
+            for name, unit, old_median, new_median in rows]
+
+
+def comparison_report(rows):
+    lines = ['{0:<24} {1:>10} {2:>10} {3:>8}'.format('median', 'before', 'after', 'change')]
+    for name, unit, before, after, change in rows:
+        lines.append('{0:<24} {1:>10} {2:>10} {3:>8}'.format(
+            name, '-' if before is None else format_value(before, unit),
+            '-' if after is None else format_value(after, unit),
+            '' if change is None else '%+.1f%%' % change))
+    return '\n'.join(lines)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(summary, path):
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=1, sort_keys=True)
@@ -0,0 +1,129 @@
+"""
+Works out how to shorten the boot of an installed machine from its tuning
+profile and hardware, and renders the first-boot report that measures the
+result with systemd-analyze. As with the tuning, every decision is kept
+with the reason it was made.
+"""
+from __future__ import print_function
+
+import json
+import re
+
+# Services that have a socket starting them on first use, so that they
+# need not start at boot. avahi-daemon is not one of them: until it runs
+# the host announces nothing over mDNS, and it is found by name that way
+socket_units = {
+    'docker': 'docker.socket',
+}
+
+# Profiles on which nothing should wait for the network to come up before
+# boot is done
+no_wait_online_profiles = ['desktop', 'laptop']
+
+# Stages of boot as systemd-analyze time names them, in order
+stages = ['firmware', 'loader', 'kernel', 'initrd', 'userspace']
+
+report_path = '/var/log/fabulous/boot-report.txt'
+report_script_path = '/usr/local/lib/fabulous/boot-report'
+
+# Runs in the background from the first boot on, until it has written a
+# report. It waits for boot to finish, as systemd-analyze refuses to
+# report on a boot that has not
+report_script = '''#!/bin/sh
+systemctl is-system-running --wait > /dev/null 2>&1
+mkdir -p {directory}
+{{
+    echo '== time =='
+    systemd-analyze time
+    echo '== critical-chain =='
+    systemd-analyze critical-chain --no-pager
+    echo '== blame =='
+    systemd-analyze blame --no-pager
+}} > {path}.tmp 2>&1
+mv {path}.tmp {path}
+'''.format(directory=report_path.rsplit('/', 1)[0], path=report_path)
+
+report_unit = '''[Unit]
+Description=Report how long the first boot took
+ConditionPathExists=!{path}
+
+[Service]
+Type=simple
+ExecStart={script}
+
+[Install]
+WantedBy=multi-user.target
+'''.format(path=report_path, script=report_script_path)
+
+
+def plan(profile, disk_type, efi, services, report=True):
+    """
+    Return the boot tuning for a machine with the tuning profile and
+    kind of disk given, booting with EFI or not, and enabling services,
+    as a dict of the choices and the reasons for each.
+    """
+    boot = {'profile': profile, 'loader_timeout': None, 'compression': None, 'sockets': {},
+            'disable': [], 'report': report, 'reasons': []}
+    reasons = boot['reasons']
+    if report:
+        reasons.append('First boot timing reported to %s' % report_path)
+    if profile == 'none':
+        reasons.append('No boot tuning for profile none')
+        return boot
+
+    if efi:
+        boot['loader_timeout'] = 0
+        reasons.append('systemd-boot menu hidden unless a key is held, instead of waiting')
+    else:
+        reasons.append('syslinux timeout left at 0.1s, as 0 would wait forever')
+
+    if disk_type == 'hdd':
+        boot['compression'] = 'zstd'
+        reasons.append('zstd initramfs, reading less from a rotational disk')
+    else:
+        boot['compression'] = 'lz4'
+        reasons.append('lz4 initramfs, the fastest to unpack, as reads from %s disks are '
+                       'cheap' % disk_type)
+
+    for service in services:
+        if service in socket_units:
+            boot['sockets'][service] = socket_units[service]
+            reasons.append('%s started on first use by %s' % (service, socket_units[service]))
+
+    if profile in no_wait_online_profiles:
+        boot['disable'].append('NetworkManager-wait-online.service')
+        reasons.append('Boot does not wait for the network on a %s' % profile)
+    return boot
+
+
+def parse_duration(text):
+    """Return a systemd duration such as 1min 2.345s or 734ms in seconds."""
+    units = {'h': 3600, 'min': 60, 's': 1, 'ms': 1e-3, 'us': 1e-6}
+    return sum(float(value) * units[unit]
+               for value, unit in re.findall(r'(\d+(?:\.\d+)?)(h|min|ms|us|s)\b', text))
+
+
+def parse_report(text):
+    """
+    Return the report written by report_script as a dict of the time each
+    stage of boot took, the total, the critical chain and the units by the
+    time they took to start, slowest first.
+    """
+    sections = dict(re.findall(r'^== (\S+) ==\n(.*?)(?=^== |\Z)', text, re.MULTILINE | re.DOTALL))
+    times = {}
+    startup = re.search(r'Startup finished in (.*?) = (.*)', sections.get('time', ''))
+    if startup:
+        for duration, stage in re.findall(r'([\d.][^(+]*?) \((\w+)\)', startup.group(1)):
+            times[stage] = parse_duration(duration)
+        times['total'] = parse_duration(startup.group(2).split('\n')[0])
+    blame = []
+    for line in sections.get('blame', '').splitlines():
+        match = re.match(r'^\s*(.*\S)\s+(\S+)$', line)
+        if match and parse_duration(match.group(1)):
+            blame.append((match.group(2), parse_duration(match.group(1))))
+    return {'times': times, 'critical_chain': sections.get('critical-chain', '').strip(),
+            'blame': sorted(blame, key=lambda unit: -unit[1])}
+
+
+def report(boot):
+    return json.dumps(boot, indent=1, sort_keys=True)
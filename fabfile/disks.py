@@ -0,0 +1,77 @@
+"""
+Prepares the disks of an install in a single remote script. Partition
+tables are written with sfdisk instead of by typing into an interactive
+tool, disks that support discard are discarded whole before anything is
+written, boot and root are formatted at the same time, and udev is waited
+for whenever device nodes change.
+
+Every disk gets the same layout, a 200M boot partition followed by root.
+With several disks root is a btrfs RAID1 of their root partitions, and only
+the boot partition of the first disk is used.
+"""
+from __future__ import print_function
+
+boot_size = '200MiB'
+
+
+def partition_path(device, number):
+    """
+    Return the path of partition number of device. Devices whose name ends
+    in a digit, such as /dev/loop0, /dev/nvme0n1 and /dev/mmcblk0, separate
+    it from the partition number with a p.
+    """
+    separator = 'p' if device[-1:].isdigit() else ''
+    return '%s%s%d' % (device, separator, number)
+
+
+def layout(efi):
+    """Return the sfdisk script of the partition table of each disk."""
+    if efi:
+        return 'label: gpt\nsize=%s, type=U, name=boot\ntype=L, name=root\n' % boot_size
+    return 'label: dos\nsize=%s, type=L\ntype=L\n' % boot_size
+
+
+def prepare_script(devices, efi, label):
+    """
+    Return the script partitioning and formatting devices, with root
+    labelled label.
+    """
+    boot = partition_path(devices[0], 1)
+    roots = ' '.join(partition_path(device, 2) for device in devices)
+    if efi:
+        mkfs_boot = 'mkfs.vfat -F32 -n "boot" %s' % boot
+    else:
+        mkfs_boot = 'mkfs.ext4 -q -m 0 -E nodiscard -L "boot" %s' % boot
+    raid = '-d raid1 -m raid1 ' if len(devices) > 1 else ''
+    return r"""set -e
+devices="{devices}"
+# Nothing on the disks may stay in use, a partition can be mounted several
+# times over
+for part in $(lsblk -lnpo NAME $devices); do
+    swapoff "$part" 2>/dev/null || true
+    while umount -l "$part" 2>/dev/null; do :; done
+done
+# Discarding each disk whole at once is far faster than mkfs discarding
+# every partition after the other, which it is then told not to
+for dev in $devices; do
+    if [ "$(cat /sys/block/${{dev##*/}}/queue/discard_max_bytes 2>/dev/null || echo 0)" != 0 ]; then
+        blkdiscard "$dev" || true &
+    fi
+done
+wait
+for dev in $devices; do
+    sfdisk -q --wipe always --wipe-partitions always "$dev" <<'EOF'
+{layout}EOF
+done
+udevadm settle
+{mkfs_boot} &
+boot=$!
+mkfs.btrfs -q -f -K {raid}-L "{label}" {roots} &
+root=$!
+rc=0
+wait $boot || rc=$?
+wait $root || rc=$?
+[ $rc = 0 ]
+# Labels are looked up from udev, by genfstab among others
+udevadm settle""".format(devices=' '.join(devices), layout=layout(efi), mkfs_boot=mkfs_boot,
+                         raid=raid, label=label, roots=roots)
@@ -0,0 +1,297 @@
+"""
+Backends that the commands of an install are run through. The default runs
+them on the remote host with Fabric. The others record a real install's
+command outputs, or replay canned outputs without a host at all, so that an
+install can be simulated in well under a second and its remote round trips
+and bytes counted.
+"""
+from __future__ import print_function
+
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+import re
+import time
+
+from fabric.api import env, get as fabric_get, put as fabric_put, sudo as fabric_sudo
+from fabric.context_managers import remote_tunnel
+from fabric import state
+
+# Outputs given to the commands of a simulated install that have no
+# recorded output, as dicts of pattern, stdout and return_code. The first
+# pattern matching the command is used. Commands matching none succeed
+# with no output. The commands of a probe script are answered one by one.
+default_responses = [
+    {'pattern': r'^test -b (?!/dev/)', 'return_code': 1},
+    {'pattern': r'^mktemp -d$', 'stdout': '/tmp/tmp.fabulous'},
+    {'pattern': r'losetup -P --show ', 'stdout': '/dev/loop0'},
+    {'pattern': r'/proc/sys/kernel/random/boot_id', 'stdout': json.dumps({
+        'version': 1, 'boot_id': '00000000-0000-0000-0000-000000000000',
+        'cpu_vendor': 'GenuineIntel', 'cpu_model': 'Intel(R) Core(TM) i5-6500 CPU @ 3.20GHz',
+        'cpus': 4, 'mem_kb': 8048000, 'virt': 'none', 'efi': True,
+        'gpus': ['00:02.0 VGA compatible controller: Intel Corporation HD Graphics 530'],
+        'power_supplies': ['AC'], 'root_disk': '',
+        'disks': [{'name': 'sda', 'rotational': False, 'size': 256060514304}],
+        'interfaces': ['enp0s31f6'], 'gateway': '192.168.1.1',
+        'default_interface': 'enp0s31f6', 'dns': True})},
+    {'pattern': r'^cat \S*/var/lib/fabulous/completed-phases$', 'return_code': 1},
+    {'pattern': r'^lsblk -o label ', 'stdout': 'sim-btrfs'},
+]
+
+# A command of a script made by probe() in arch.py, and its name
+probe_pattern = re.compile(r"^\(\n(.*?)\n\) 2>&1; printf '\\n@@probe (\S+) %d\\n' \$\?$",
+                           re.DOTALL | re.MULTILINE)
+
+
+class Result(str):
+    """Output of a command, with the attributes of Fabric's results."""
+
+    def __new__(cls, stdout='', return_code=0, stderr=''):
+        result = str.__new__(cls, stdout)
+        result.return_code = return_code
+        result.succeeded = return_code == 0
+        result.failed = not result.succeeded
+        result.stderr = stderr
+        return result
+
+
+class Executor(object):
+    """
+    Runs the commands of an install and counts its round trips and bytes.
+    Subclasses implement run_sudo(), run_put() and run_get(), and connect()
+    and tunnel() if they have a connection to open. simulated is set when
+    nothing reaches a real host, so that nothing is served for one either.
+    """
+    simulated = False
+
+    def __init__(self):
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.calls = defaultdict(int)
+
+    def sudo(self, command, **kwargs):
+        result = self.run_sudo(command, **kwargs)
+        self.count('sudo', len(command), len(result) + len(result.stderr))
+        return result
+
+    def put(self, local_path, remote_path, **kwargs):
+        result = self.run_put(local_path, remote_path, **kwargs)
+        self.count('put', os.path.getsize(os.path.expanduser(local_path)), 0)
+        return result
+
+    def get(self, remote_path, local_path, **kwargs):
+        result = self.run_get(remote_path, local_path, **kwargs)
+        size = os.path.getsize(local_path) if os.path.isfile(local_path) else 0
+        self.count('get', 0, size)
+        return result
+
+    def connect(self):
+        """Open the connection commands are run over. Returns the seconds it took."""
+        return 0
+
+    @contextmanager
+    def tunnel(self, port):
+        """Forward port on the host to the same port on this machine in this block."""
+        yield
+
+    def count(self, kind, sent, received):
+        self.round_trips += 1
+        self.calls[kind] += 1
+        self.bytes_sent += sent
+        self.bytes_received += received
+
+    def stats(self):
+        return {'round_trips': self.round_trips, 'calls': dict(self.calls),
+                'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received}
+
+
+class FabricExecutor(Executor):
+    """
+    Runs commands on the current host with Fabric, which multiplexes every
+    command and transfer over one SSH transport per host.
+    """
+
+    def connect(self):
+        # Keep the transport alive through long silent commands, like
+        # pacstrap on a slow mirror, instead of reconnecting after NAT or
+        # firewalls drop it
+        env.keepalive = env.keepalive or 30
+        start = time.time()
+        state.connections[env.host_string]
+        return time.time() - start
+
+    def tunnel(self, port):
+        return remote_tunnel(port)
+
+    def run_sudo(self, command, **kwargs):
+        return fabric_sudo(command, **kwargs)
+
+    def run_put(self, local_path, remote_path, **kwargs):
+        return fabric_put(local_path=local_path, remote_path=remote_path, **kwargs)
+
+    def run_get(self, remote_path, local_path, **kwargs):
+        return fabric_get(remote_path=remote_path, local_path=local_path, **kwargs)
+
+
+def command_key(command):
+    """
+    Return the key recorded outputs are found by for command. Commands are
+    recorded by their hash alone, so that recordings can be shared without
+    the passwords and other secrets some commands hold.
+    """
+    if isinstance(command, unicode):
+        command = command.encode('utf-8')
+    return hashlib.sha256(command).hexdigest()
+
+
+class RecordingExecutor(Executor):
+    """
+    Runs commands through another executor and keeps the output of each,
+    to be saved and replayed by ReplayExecutor later.
+    """
+
+    def __init__(self, inner):
+        Executor.__init__(self)
+        self.inner = inner
+        self.recording = []
+
+    def run_sudo(self, command, **kwargs):
+        result = self.inner.sudo(command, **kwargs)
+        self.recording.append({'sha256': command_key(command), 'stdout': str(result),
+                               'return_code': result.return_code})
+        return result
+
+    def run_put(self, local_path, remote_path, **kwargs):
+        return self.inner.put(local_path, remote_path, **kwargs)
+
+    def run_get(self, remote_path, local_path, **kwargs):
+        return self.inner.get(remote_path, local_path, **kwargs)
+
+    def tunnel(self, port):
+        return self.inner.tunnel(port)
+
+    @property
+    def simulated(self):
+        return self.inner.simulated
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.recording, f, indent=1)
+
+
+class CountingExecutor(Executor):
+    """
+    Runs commands through another executor, counting the round trips and
+    bytes of a part of an install separately from the rest.
+    """
+
+    def __init__(self, inner):
+        Executor.__init__(self)
+        self.inner = inner
+
+    def run_sudo(self, command, **kwargs):
+        return self.inner.sudo(command, **kwargs)
+
+    def run_put(self, local_path, remote_path, **kwargs):
+        return self.inner.put(local_path, remote_path, **kwargs)
+
+    def run_get(self, remote_path, local_path, **kwargs):
+        return self.inner.get(remote_path, local_path, **kwargs)
+
+    def connect(self):
+        return self.inner.connect()
+
+    def tunnel(self, port):
+        return self.inner.tunnel(port)
+
+    @property
+    def simulated(self):
+        return self.inner.simulated
+
+
+class ReplayExecutor(Executor):
+    """
+    Answers commands from recorded outputs, in the order they were recorded
+    for each command, then from patterns, without running anything.
+    """
+    simulated = True
+
+    def __init__(self, responses=None):
+        Executor.__init__(self)
+        self.recorded = defaultdict(deque)
+        self.patterns = []
+        for response in list(responses or []) + default_responses:
+            if 'sha256' in response:
+                self.recorded[response['sha256']].append(response)
+            elif 'command' in response:
+                self.recorded[command_key(response['command'])].append(response)
+            else:
+                self.patterns.append(dict(response, regex=re.compile(response['pattern'])))
+        self.commands = []
+
+    def respond(self, command):
+        key = command_key(command)
+        if self.recorded[key]:
+            return self.recorded[key].popleft()
+        for response in self.patterns:
+            if response['regex'].search(command):
+                return response
+        return {}
+
+    def run_sudo(self, command, **kwargs):
+        self.commands.append(command)
+        if probe_pattern.search(command):
+            result = Result(''.join(
+                "%s\n@@probe %s %d\n" % (response.get('stdout', ''), name,
+                                          response.get('return_code', 0))
+                for name, response in ((name, self.respond(command))
+                                       for command, name in probe_pattern.findall(command))))
+        else:
+            response = self.respond(command)
+            result = Result(response.get('stdout', ''), response.get('return_code', 0))
+        if kwargs.get('stdout') and result:
+            kwargs['stdout'].write(result + '\n')
+        if result.failed and not (kwargs.get('quiet') or kwargs.get('warn_only')):
+            raise SystemExit('Replayed command failed with exit code %d: %s' % (
+                result.return_code, command))
+        return result
+
+    def run_put(self, local_path, remote_path, **kwargs):
+        self.commands.append('put %s' % remote_path)
+        return [remote_path]
+
+    def run_get(self, remote_path, local_path, **kwargs):
+        self.commands.append('get %s' % remote_path)
+        return [local_path]
+
+    @contextmanager
+    def tunnel(self, port):
+        self.commands.append('tunnel %d' % port)
+        yield
+
+
+_current = FabricExecutor()
+
+
+def current():
+    """Return the executor commands are run through."""
+    return _current
+
+
+@contextmanager
+def use(executor):
+    """Run the commands made in this block through executor."""
+    global _current
+    previous, _current = _current, executor
+    try:
+        yield executor
+    finally:
+        _current = previous
+
+
+def load_responses(path):
+    with open(os.path.expanduser(path)) as f:
+        return json.load(f)
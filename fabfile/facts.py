@@ -0,0 +1,197 @@
+"""
+Collects what the install's decisions depend on about a host, its CPU,
+GPUs, firmware, power supplies, memory, disks and network, with a single
+remote command that prints them as JSON.
+
+Facts are cached per host on the machine controlling the install. The
+cache is only used while the host has not rebooted since it was made, and
+for at most its TTL; the probe is sent either way, but answers with the
+boot ID alone while the cache is still good. A saved copy of the facts can
+be given to an install instead of probing, to make its decisions again
+without the host.
+"""
+from __future__ import print_function
+
+import json
+import os
+import pipes
+import re
+import time
+
+cache_dir = '~/.cache/fabulous/facts'
+
+# Raised when the probe changes, so that caches made by the old one are
+# collected again
+version = 1
+
+# Prints the facts as JSON, or only the boot ID if it is $cached_boot_id
+script = r"""boot_id=$(cat /proc/sys/kernel/random/boot_id)
+if [ "$boot_id" = "$cached_boot_id" ]; then
+    printf '{"version": %d, "boot_id": "%s", "cached": true}\n' @VERSION@ "$boot_id"
+    exit 0
+fi
+# Missing tools leave their fact empty, their errors would break the JSON
+exec 2>/dev/null
+q() { printf '"%s"' "$(printf '%s' "$1" | sed 's/\\/\\\\/g; s/"/\\"/g')"; }
+list() {
+    local sep= line
+    printf '['
+    while IFS= read -r line; do
+        [ -n "$line" ] || continue
+        printf '%s%s' "$sep" "$(q "$line")"
+        sep=', '
+    done
+    printf ']'
+}
+printf '{"version": %d, "boot_id": %s' @VERSION@ "$(q "$boot_id")"
+printf ', "cpu_vendor": %s' "$(q "$(awk -F': ' '/^vendor_id/ {print $2; exit}' /proc/cpuinfo)")"
+printf ', "cpu_model": %s' "$(q "$(awk -F': ' '/^model name/ {print $2; exit}' /proc/cpuinfo)")"
+printf ', "cpus": %d' "$(nproc)"
+printf ', "mem_kb": %d' "$(awk '/^MemTotal:/ {print $2}' /proc/meminfo)"
+printf ', "virt": %s' "$(q "$(systemd-detect-virt)")"
+printf ', "efi": %s' "$(efibootmgr &>/dev/null && echo true || echo false)"
+printf ', "gpus": %s' "$(lspci | grep -E 'VGA|3D controller' | list)"
+printf ', "power_supplies": %s' "$(ls /sys/class/power_supply 2>/dev/null | list)"
+printf ', "root_disk": %s' "$(q "$(lsblk -ndo PKNAME "$(findmnt -nvo SOURCE -T /)" | head -n1)")"
+printf ', "disks": %s' "$(lsblk -dnbo NAME,ROTA,SIZE,TYPE | awk '
+    BEGIN {printf "["}
+    $4 != "rom" {
+        printf "%s{\"name\": \"%s\", \"rotational\": %s, \"size\": %s}", sep, $1,
+            $2 == "1" ? "true" : "false", $3
+        sep = ", "
+    }
+    END {printf "]"}')"
+printf ', "interfaces": %s' "$(ls /sys/class/net | grep -vx lo | list)"
+printf ', "gateway": %s' "$(q "$(ip route show default | awk '/via/ {print $3; exit}')")"
+printf ', "default_interface": %s' "$(q "$(ip route show default | awk '/dev/ {print $5; exit}')")"
+printf ', "dns": %s' "$(getent hosts archlinux.org &>/dev/null && echo true || echo false)"
+printf '}\n'
+""".replace('@VERSION@', str(version))
+
+
+def cache_path(host, path=cache_dir):
+    return os.path.join(os.path.expanduser(path), re.sub(r'[^\w.@-]', '_', host) + '.json')
+
+
+def load(host, ttl=86400, path=cache_dir):
+    """Return the cached facts of host, or None if there are none usable."""
+    if not host or not os.path.isfile(cache_path(host, path)):
+        return None
+    with open(cache_path(host, path)) as f:
+        facts = json.load(f)
+    if facts.get('version') != version or time.time() - facts.get('time', 0) > float(ttl):
+        return None
+    return facts
+
+
+def save(host, facts, path=cache_dir):
+    if not host:
+        return
+    path = cache_path(host, path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + '.tmp', 'w') as f:
+        json.dump(facts, f, indent=1, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def command(cached=None):
+    """Return the probe, answering with the boot ID alone if it matches cached."""
+    return "cached_boot_id='%s'\n%s" % (cached['boot_id'] if cached else '', script)
+
+
+def parse(output, cached=None):
+    """
+    Return the facts printed by the probe, or the cached facts if the probe
+    found them still good. Raises ValueError if the output is not facts.
+    """
+    facts = json.loads(output.strip().splitlines()[-1] if output.strip() else '')
+    if facts.get('cached') and cached and cached['boot_id'] == facts['boot_id']:
+        return dict(cached, cached=True)
+    facts['time'] = time.time()
+    facts['cached'] = False
+    return facts
+
+
+def load_file(path):
+    with open(os.path.expanduser(path)) as f:
+        return dict(json.load(f), cached=True)
+
+
+def intel(facts):
+    return facts['cpu_vendor'] == 'GenuineIntel'
+
+
+def laptop(facts):
+    return any(name.startswith('BAT') for name in facts['power_supplies'])
+
+
+def gpu(facts):
+    """
+    Return the kind of GPU the host has, as in arch.valid_gpus, or generic
+    if it is none of those.
+    """
+    gpus = '\n'.join(facts['gpus']).lower()
+    if 'vmware' in gpus:
+        return 'vmware'
+    if 'qxl' in gpus:
+        return 'qxl'
+    if 'intel' in gpus:
+        return 'intel'
+    if 'nvidia' in gpus:
+        return 'nvidia'
+    if 'amd' in gpus:
+        return 'amd'
+    if 'virtualbox' in gpus:
+        return 'vbox'
+    return 'generic'
+
+
+def disk_type(name, rotational):
+    if name.startswith('nvme'):
+        return 'nvme'
+    if name.startswith(('vd', 'xvd')):
+        # Whether they say they are rotational says little about the host
+        return 'virtual'
+    if rotational:
+        return 'hdd'
+    return 'ssd'
+
+
+def target_disk_command(target):
+    """
+    Return the command printing the name and rotational flag of the disk
+    holding target, a block device or a directory on a mounted filesystem.
+    Partitions give their parent disk.
+    """
+    return ('if [ -b {0} ]; then source={0}; else source=$(findmnt -nvo SOURCE -T {0}); fi; '
+            'disk=$(lsblk -ndo PKNAME "$source" | head -n1); '
+            'lsblk -dno NAME,ROTA "/dev/${{disk:-${{source##*/}}}}"').format(pipes.quote(target))
+
+
+def parse_target_disk(output):
+    """
+    Return the disk name and whether it is rotational printed by the command
+    of target_disk_command(), or an empty name and None if it found none.
+    """
+    fields = output.split()
+    if len(fields) != 2 or fields[1] not in ('0', '1'):
+        return '', None
+    return fields[0], fields[1] == '1'
+
+
+def tuning_facts(facts, disk, rotational=None):
+    """
+    Return the facts tuning.tune() needs, for the disk named disk, or the
+    disk holding / if disk is empty. Whether the disk is rotational is
+    looked up in the facts unless it is given.
+    """
+    disk = disk or facts['root_disk']
+    if rotational is None:
+        rotational = any(d['rotational'] for d in facts['disks'] if d['name'] == disk)
+    return {'mem_kb': facts['mem_kb'], 'cpus': facts['cpus'], 'virt': facts['virt'],
+            'disk': disk, 'rotational': rotational, 'disk_type': disk_type(disk, rotational)}
+
+
+def report(facts):
+    return json.dumps(facts, indent=1, sort_keys=True)
@@ -0,0 +1,96 @@
+"""
+Ranks pacman mirrors from the machine controlling the install. Every
+candidate is timed at once, fetching the core repository database, and the
+ranking is cached so that the hosts of a fleet and the installs that follow
+within its TTL reuse it instead of measuring again.
+"""
+from __future__ import print_function
+
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import socket
+import time
+import urllib2
+
+candidates = [
+    'https://mirrors.kernel.org/archlinux',
+    'https://geo.mirror.pkgbuild.com',
+    'https://mirrors.edge.kernel.org/archlinux',
+    'https://mirror.rackspace.com/archlinux',
+    'https://mirror.leaseweb.net/archlinux',
+    'https://ftp.fau.de/archlinux',
+    'https://mirrors.mit.edu/archlinux',
+    'https://mirror.aarnet.edu.au/pub/archlinux',
+]
+cache_path = '~/.cache/fabulous/mirrors.json'
+
+# Mirrors are ranked by the time they would take to serve a package of
+# this size, which weighs their latency against their throughput
+reference_size = 10 << 20
+
+
+def measure(mirror, timeout=5):
+    """
+    Time fetching the core database from mirror. Returns its latency,
+    throughput and score, or None if it failed or took longer than timeout.
+    """
+    url = mirror.rstrip('/') + '/core/os/x86_64/core.db'
+    start = time.time()
+    try:
+        response = urllib2.urlopen(url, timeout=timeout)
+        latency = time.time() - start
+        size = 0
+        for chunk in iter(lambda: response.read(1 << 16), b''):
+            size += len(chunk)
+            if time.time() - start > timeout:
+                return None
+    except (urllib2.URLError, IOError, socket.timeout):
+        return None
+    throughput = size / max(time.time() - start - latency, 1e-3)
+    return {'url': mirror, 'latency': latency, 'throughput': throughput,
+            'score': latency + reference_size / max(throughput, 1.0)}
+
+
+def rank(mirrors, timeout=5):
+    """Measure every mirror at once and return those that answered, best first."""
+    pool = ThreadPool(len(mirrors))
+    try:
+        results = pool.map(lambda mirror: measure(mirror, timeout), mirrors)
+    finally:
+        pool.close()
+    return sorted((result for result in results if result), key=lambda result: result['score'])
+
+
+def ranked(mirrors=None, ttl=21600, timeout=5, path=cache_path):
+    """
+    Return the ranking of mirrors, or of the default candidates, from the
+    cache at path if it was made for the same mirrors less than ttl seconds
+    ago, measuring them again otherwise.
+    """
+    mirrors = sorted(mirrors or candidates)
+    path = os.path.expanduser(path)
+    if os.path.isfile(path):
+        with open(path) as f:
+            cached = json.load(f)
+        if cached['mirrors'] == mirrors and time.time() - cached['time'] < float(ttl):
+            return cached['ranking']
+    ranking = rank(mirrors, timeout)
+    if ranking:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'time': time.time(), 'mirrors': mirrors, 'ranking': ranking}, f, indent=1)
+        os.rename(path + '.tmp', path)
+    return ranking
+
+
+def mirrorlist(urls):
+    return ''.join('Server = %s/$repo/os/$arch\n' % url.rstrip('/') for url in urls)
+
+
+def servers(text):
+    """Return the mirror URLs of the Server lines of a mirrorlist, in order."""
+    return [line.split('=', 1)[1].strip()[:-len('/$repo/os/$arch')]
+            for line in text.splitlines()
+            if line.startswith('Server') and line.rstrip().endswith('/$repo/os/$arch')]
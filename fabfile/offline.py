@@ -0,0 +1,84 @@
+"""
+Offline install bundles. A bundle is a tar archive holding every package an
+install of a given configuration needs, resolved down to the last
+dependency, as a pacman repository with its own database, along with the
+other files the install would otherwise download: the dray.be repository
+package and the signing keys of third party repositories.
+
+On the host being installed the bundle is unpacked to remote_dir, and the
+pacman.conf it carries makes that repository the only one pacman uses.
+"""
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import tarfile
+import time
+
+remote_dir = '/var/tmp/fabulous-bundle'
+repo_name = 'fabulous-bundle'
+
+# Resolves and downloads the packages named in its arguments into
+# $dir/repo, then archives $dir as $dir.tar. The packages are resolved
+# against an empty local database, so that the whole dependency closure is
+# fetched, and are checked by pacman's own signature and checksum checks
+# when it installs them
+build_script = r'''#!/bin/bash
+set -e
+dir=$1 workers=$2 dray=$3 keys=$4
+shift 4
+mkdir -p "$dir/repo" "$dir/keys" "$dir/db/local" "$dir/empty"
+pacman -Sy
+cp -a /var/lib/pacman/sync "$dir/db/"
+pacman --dbpath "$dir/db" --cachedir "$dir/empty" --noconfirm -Sp "$@" | grep '://' > "$dir/urls"
+cd "$dir/repo"
+xargs -P "$workers" -n 1 curl -fsSLO --retry 3 < "$dir/urls"
+# Packages of unsigned repositories have no signature to fetch
+sed 's/$/.sig/' "$dir/urls" | xargs -P "$workers" -n 1 curl -fsLO --retry 3 || true
+repo-add -q "$dir/repo/fabulous-bundle.db.tar.gz" $(ls -d "$dir"/repo/*.pkg.tar.* | grep -v '\.sig$')
+curl -fsSL --retry 3 -o "$dir/dray-repo.pkg.tar.xz" "$dray"
+for key in $keys; do
+    pacman-key --export "$key" > "$dir/keys/$key.asc"
+done
+echo "$(wc -l < "$dir/urls") packages, $(du -sh "$dir/repo" | cut -f1)"
+rm -rf "$dir/db" "$dir/empty" "$dir/urls"
+tar -C "$dir" -cf "$dir.tar" .
+'''
+
+
+def pacman_conf():
+    """
+    Return the pacman.conf that installs from the bundle unpacked in
+    remote_dir. Packages that came with a signature are checked against it;
+    the database pins the checksum of every package either way.
+    """
+    return """[options]
+HoldPkg = pacman glibc
+Architecture = auto
+CheckSpace
+SigLevel = Required DatabaseOptional
+LocalFileSigLevel = Optional
+
+[{0}]
+SigLevel = Optional TrustAll
+Server = file://{1}/repo
+""".format(repo_name, remote_dir)
+
+
+def manifest(config, packages):
+    """
+    Return the manifest of a bundle of packages built for config. Its id
+    only depends on what was asked for, so bundles built from the same
+    configuration share it.
+    """
+    packages = sorted(set(packages))
+    identity = json.dumps({'config': config, 'packages': packages}, sort_keys=True)
+    return {'id': hashlib.sha256(identity).hexdigest()[:16], 'config': config,
+            'packages': packages, 'created': time.time()}
+
+
+def read_manifest(path):
+    """Return the manifest of the local bundle at path."""
+    with tarfile.open(os.path.expanduser(path)) as archive:
+        return json.load(archive.extractfile('./manifest.json'))
@@ -0,0 +1,224 @@
+"""
+Caching proxy for pacman packages, run on the machine controlling the
+install and reached by the targets through an SSH tunnel.
+
+Packages are stored once per sha256 checksum, however many mirrors or
+repositories they were requested through, and the least recently used ones
+are evicted when the cache grows past its size limit. Repository databases
+change constantly and are passed through without being cached.
+"""
+from __future__ import print_function
+
+import BaseHTTPServer
+import hashlib
+import json
+import os
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import urllib2
+
+# Appended to the mirrorlist entry pointing at the proxy, so it can be removed
+marker = '# fabulous-cache'
+package_suffixes = ('.pkg.tar.xz', '.pkg.tar.zst', '.pkg.tar.gz', '.pkg.tar', '.sig')
+
+# The proxy started in this process, if any
+_server = None
+
+
+def parse_size(size):
+    """Return a size like 500M or 20G in bytes."""
+    size = str(size).strip().upper()
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+class PackageCache(object):
+    """
+    Content-addressed package store. index.json maps file names to the
+    checksum of their content, which is stored under objects/.
+    """
+
+    def __init__(self, root, max_size):
+        self.root = os.path.expanduser(root)
+        self.max_size = parse_size(max_size)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_hit = 0
+        self.bytes_fetched = 0
+        if not os.path.isdir(os.path.join(self.root, 'objects')):
+            os.makedirs(os.path.join(self.root, 'objects'))
+        self.index_path = os.path.join(self.root, 'index.json')
+        self.index = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def object_path(self, checksum):
+        return os.path.join(self.root, 'objects', checksum[:2], checksum)
+
+    def lookup(self, name):
+        """Return the path holding name, or None if it is not cached."""
+        with self.lock:
+            entry = self.index.get(name)
+            if entry and os.path.isfile(self.object_path(entry['sha256'])):
+                entry['used'] = time.time()
+                self.hits += 1
+                self.bytes_hit += entry['size']
+                return self.object_path(entry['sha256'])
+            self.misses += 1
+            return None
+
+    def store(self, name, path):
+        """Move the downloaded file at path into the cache as name."""
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(chunk)
+        checksum = sha256.hexdigest()
+        size = os.path.getsize(path)
+        with self.lock:
+            target = self.object_path(checksum)
+            if os.path.isfile(target):
+                os.unlink(path)
+            else:
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                shutil.move(path, target)
+            self.bytes_fetched += size
+            self.index[name] = {'sha256': checksum, 'size': size, 'used': time.time()}
+            self.evict()
+            self.save()
+
+    def size(self):
+        return sum(dict((e['sha256'], e['size']) for e in self.index.values()).values())
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits in max_size."""
+        by_age = sorted(self.index.items(), key=lambda item: item[1]['used'])
+        while by_age and self.size() > self.max_size:
+            name, entry = by_age.pop(0)
+            del self.index[name]
+            if not any(e['sha256'] == entry['sha256'] for e in self.index.values()):
+                os.unlink(self.object_path(entry['sha256']))
+
+    def save(self):
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.rename(self.index_path + '.tmp', self.index_path)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / requests if requests else 0.0,
+            'bytes_from_cache': self.bytes_hit,
+            'bytes_fetched': self.bytes_fetched,
+            'size': self.size(),
+            'packages': len(self.index),
+        }
+
+
+class ProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        name = self.path.rsplit('/', 1)[-1]
+        cacheable = name.endswith(package_suffixes)
+        cached = self.server.cache.lookup(name) if cacheable else None
+        if cached:
+            self.send_file(cached)
+            return
+        for mirror in self.server.upstreams:
+            try:
+                response = urllib2.urlopen(mirror.rstrip('/') + self.path, timeout=30)
+            except (urllib2.URLError, IOError):
+                continue
+            self.relay(response, name if cacheable else None)
+            return
+        self.send_error(404)
+
+    def send_file(self, path):
+        self.send_response(200)
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile)
+
+    def relay(self, response, name):
+        """Stream an upstream response to the client, caching it as name."""
+        self.send_response(200)
+        length = response.info().get('Content-Length')
+        if length:
+            self.send_header('Content-Length', length)
+        self.end_headers()
+        out = None
+        if name:
+            out = tempfile.NamedTemporaryFile(dir=self.server.cache.root, delete=False)
+        try:
+            for chunk in iter(lambda: response.read(1 << 16), b''):
+                self.wfile.write(chunk)
+                if out:
+                    out.write(chunk)
+        except Exception:
+            if out:
+                out.close()
+                os.unlink(out.name)
+            raise
+        if out:
+            out.close()
+            self.server.cache.store(name, out.name)
+
+
+class ProxyServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, cache, upstreams):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), ProxyHandler)
+        self.cache = cache
+        self.upstreams = upstreams
+
+
+def start(cache_dir, max_size, upstreams, port):
+    """
+    Start the proxy in a background thread unless this process already has
+    one. Returns True if it was started by this call.
+    """
+    global _server
+    if _server:
+        return False
+    _server = ProxyServer(int(port), PackageCache(cache_dir, max_size), upstreams)
+    thread = threading.Thread(target=_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return True
+
+
+def stop():
+    """Stop the proxy and return its statistics."""
+    global _server
+    stats = _server.cache.stats()
+    _server.shutdown()
+    _server.server_close()
+    _server = None
+    return stats
+
+
+def mirror_line(port):
+    return 'Server = http://localhost:%d/$repo/os/$arch %s' % (int(port), marker)
+
+
+def format_stats(stats):
+    return ('{hits} hits, {misses} misses ({rate:.0%} hit rate), '
+            '{served:.1f} MiB served from cache, {fetched:.1f} MiB fetched'.format(
+                rate=stats['hit_rate'], served=stats['bytes_from_cache'] / 1048576.0,
+                fetched=stats['bytes_fetched'] / 1048576.0, **stats))
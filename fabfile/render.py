@@ -0,0 +1,70 @@
+"""
+Renders the files an install writes as complete files in memory, and the
+shell commands that put them in place, so that the files of a whole batch
+of chroot commands travel to the host in a single archive instead of a
+command each.
+
+Files a package already ships, such as /etc/hosts and /etc/locale.gen, are
+edited line by line instead, and every edit checks for its line first, so
+that running a phase again leaves them as they were.
+"""
+from __future__ import print_function
+
+import base64
+import io
+import pipes
+import tarfile
+import time
+
+# Where the files of an archive are unpacked in the target until the
+# commands that install them run
+staging_dir = '/var/tmp/fabulous-files'
+
+
+def archive(files):
+    """Return files, a dict of names to contents, as a gzipped tar."""
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:gz') as tar:
+        for name, content in sorted(files.items()):
+            if isinstance(content, unicode):
+                content = content.encode('utf-8')
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mtime = time.time()
+            info.mode = 0600
+            tar.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+def unpack_command(files, directory):
+    """
+    Return the command unpacking files, a dict of names to contents, into
+    directory on the host. The archive is embedded in the command, so it
+    costs no round trip of its own.
+    """
+    return "mkdir -p {0} && base64 -d <<'FABULOUS_FILES' | tar -xzf - -C {0}\n{1}\nFABULOUS_FILES\n".format(
+        directory, base64.b64encode(archive(files)))
+
+
+def install_command(source, path, mode=0644):
+    """Return the command moving the unpacked file source to path in the target."""
+    return 'install -D -m {0:o} {1} {2} && rm {1}'.format(mode, source, pipes.quote(path))
+
+
+def line_command(path, line, replace=None):
+    """
+    Return the command adding line to path unless it is there already. Lines
+    matching the sed regex replace are removed first, so that a line can
+    change between runs instead of being added again.
+    """
+    command = 'grep -qxF -- {0} {1} || '.format(pipes.quote(line), path)
+    if replace:
+        command += "{{ sed -i '/{0}/d' {1} && echo {2} >> {1}; }}".format(
+            replace, path, pipes.quote(line))
+    else:
+        command += 'echo {0} >> {1}'.format(pipes.quote(line), path)
+    return command
+
+
+def cron_script(command):
+    return '#!/bin/sh\n%s\n' % command
@@ -0,0 +1,118 @@
+"""
+Role profiles: declarative JSON files in fabfile/profiles that name the
+packages and services of a kind of machine, such as a workstation, a build
+node or a VM guest. A profile can inherit from others, adding packages and
+services to theirs and excluding some of them.
+
+Each role is resolved once per process into sorted package and service
+sets with a hash of their content. Roles that resolve to the same sets
+share the hash whatever they are called. Together with the install options
+that also change what is built, it names the base images and offline
+bundles built for them, so that every host of a role in a fleet uses the
+same ones.
+"""
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+
+directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+
+# Lists are added to those of the parents, after removing what the profile
+# excludes from them with exclude_<key>. Scalars replace the parents' values
+# when a profile sets them, and default to these
+list_keys = ['packages', 'services']
+scalar_defaults = {'gui': False, 'tuning_profile': 'auto'}
+
+# Roles already resolved in this process, by directory and name
+_resolved = {}
+
+
+def available(path=directory):
+    return sorted(name[:-len('.json')] for name in os.listdir(path) if name.endswith('.json'))
+
+
+def load(name, path=directory):
+    filename = os.path.join(path, name + '.json')
+    if not os.path.isfile(filename):
+        raise ValueError('Unknown role %s, the roles are: %s' % (name, ', '.join(available(path))))
+    with open(filename) as f:
+        return json.load(f)
+
+
+def merge(name, path=directory, chain=()):
+    """
+    Return the profile name with everything it inherits merged into it.
+    Parents are merged in order, then the profile's own exclusions and
+    values are applied, so that a profile can add back what a parent
+    excluded. Scalars are only present if some profile in the chain sets
+    them.
+    """
+    if name in chain:
+        raise ValueError('Role %s inherits from itself: %s' % (name, ' > '.join(chain + (name,))))
+    profile = load(name, path)
+    merged = dict((key, []) for key in list_keys)
+    for parent in profile.get('inherits', []):
+        inherited = merge(parent, path, chain + (name,))
+        for key in list_keys:
+            merged[key] += inherited[key]
+        for key in scalar_defaults:
+            if key in inherited:
+                merged[key] = inherited[key]
+    for key in list_keys:
+        excluded = set(profile.get('exclude_' + key, []))
+        merged[key] = [item for item in merged[key] if item not in excluded]
+        merged[key] += profile.get(key, [])
+    for key in scalar_defaults:
+        if key in profile:
+            merged[key] = profile[key]
+    return merged
+
+
+def resolve(name, path=directory):
+    """
+    Return the role name as a dict of its package and service sets, whether
+    it has a GUI, its tuning profile and the hash of all of them.
+    """
+    if (path, name) in _resolved:
+        return _resolved[(path, name)]
+    merged = merge(name, path)
+    role = {
+        'packages': sorted(set(merged['packages'])),
+        'services': sorted(set(merged['services'])),
+        'gui': bool(merged.get('gui', scalar_defaults['gui'])),
+        'tuning_profile': merged.get('tuning_profile', scalar_defaults['tuning_profile']),
+    }
+    role['hash'] = hashlib.sha256(json.dumps(role, sort_keys=True)).hexdigest()[:16]
+    role['name'] = name
+    _resolved[(path, name)] = role
+    return role
+
+
+def artifact_hash(role, gpu='auto', kernel='', extra_packages=None):
+    """
+    Return the hash of role combined with the options that change the
+    packages of an image or bundle built for it. The GPU only counts for a
+    role with a GUI. With every option at its default this is the role's
+    own hash.
+    """
+    options = {}
+    if role['gui'] and gpu != 'auto':
+        options['gpu'] = gpu
+    if kernel:
+        options['kernel'] = kernel
+    if extra_packages:
+        options['extra_packages'] = sorted(set(extra_packages))
+    if not options:
+        return role['hash']
+    return hashlib.sha256(json.dumps([role['hash'], options], sort_keys=True)).hexdigest()[:16]
+
+
+def artifact_path(path, role, **options):
+    """
+    Return path with {role} and {hash} replaced by the name of role and its
+    artifact_hash() with options, e.g. ~/images/{role}-{hash}.img.zst.
+    """
+    return os.path.expanduser(path.replace('{role}', role['name']).replace(
+        '{hash}', artifact_hash(role, **options)))
@@ -0,0 +1,144 @@
+"""
+Works out the kernel and I/O tuning of a machine from what was detected
+about its hardware, and renders it as the files written into the install.
+Every decision is recorded with the reason it was made, and saved on the
+installed machine next to the settings.
+"""
+from __future__ import print_function
+
+import json
+
+profiles = ['auto', 'server', 'desktop', 'laptop', 'vm', 'none']
+
+# Packages the tuning needs, installed whatever it decides
+packages = ['zram-generator', 'cpupower']
+
+# Writeback limits (dirty_background_bytes, dirty_bytes) for each kind of
+# disk. Slow disks get small limits, so that a burst of writes does not
+# stall the machine for seconds while it is flushed
+dirty_limits = {
+    'hdd': (16 << 20, 48 << 20),
+    'ssd': (64 << 20, 256 << 20),
+    'nvme': (256 << 20, 1 << 30),
+    'virtual': (64 << 20, 256 << 20),
+}
+
+# Machines with at most this much memory get zram swap of half their memory,
+# up to zram_max
+zram_threshold = 16 << 30
+zram_max = 8 << 30
+
+scheduler_rules = '''# Written by fabulous, see /etc/fabulous/tuning.json
+ACTION=="add|change", KERNEL=="nvme[0-9]*n[0-9]*", ATTR{queue/scheduler}="none"
+ACTION=="add|change", KERNEL=="vd[a-z]*|xvd[a-z]*", ATTR{queue/scheduler}="none"
+ACTION=="add|change", KERNEL=="sd[a-z]*|mmcblk[0-9]*", ATTR{queue/rotational}=="0", ATTR{queue/scheduler}="mq-deadline"
+ACTION=="add|change", KERNEL=="sd[a-z]*", ATTR{queue/rotational}=="1", ATTR{queue/scheduler}="bfq"
+'''
+
+
+def parse_overrides(overrides):
+    """
+    Return space separated key=value overrides as a dict. Raises ValueError
+    if an override is not key=value.
+    """
+    if not overrides:
+        return {}
+    if isinstance(overrides, dict):
+        return overrides
+    invalid = [item for item in overrides.split() if '=' not in item.strip('=')]
+    if invalid:
+        raise ValueError('Invalid tuning_overrides %s, each must be key=value' % ', '.join(invalid))
+    return dict(item.split('=', 1) for item in overrides.split())
+
+
+def pick_profile(profile, facts, laptop, gui):
+    if profile != 'auto':
+        return profile, 'profile %s was requested' % profile
+    if facts['virt'] != 'none':
+        return 'vm', 'running under %s' % facts['virt']
+    if laptop:
+        return 'laptop', 'a battery was found'
+    if gui:
+        return 'desktop', 'a GUI is installed'
+    return 'server', 'no GUI, battery or hypervisor was found'
+
+
+def tune(facts, profile='auto', overrides=None, laptop=False, gui=False):
+    """
+    Return the tuning for a machine as a dict of the profile, sysctl
+    values, zram size in bytes, CPU governor and the reasons for each.
+    """
+    profile, why = pick_profile(profile, facts, laptop, gui)
+    tuning = {'profile': profile, 'facts': facts, 'sysctl': {}, 'zram': 0,
+              'governor': None, 'reasons': ['Profile %s: %s' % (profile, why)]}
+    if profile == 'none':
+        return tuning
+    reasons = tuning['reasons']
+    sysctl = tuning['sysctl']
+    memory = facts['mem_kb'] * 1024
+
+    background, dirty = dirty_limits[facts['disk_type']]
+    if memory:
+        background, dirty = min(background, memory / 40), min(dirty, memory / 10)
+    sysctl['vm.dirty_background_bytes'] = background
+    sysctl['vm.dirty_bytes'] = dirty
+    reasons.append('Writeback limits of {0}M/{1}M for the {2} {3} and {4}M of memory'.format(
+        background >> 20, dirty >> 20, facts['disk_type'], facts['disk'] or 'disk', memory >> 20))
+    sysctl['vm.vfs_cache_pressure'] = 50
+    reasons.append('Inode and dentry caches are kept longer than page cache')
+
+    if memory and memory <= zram_threshold:
+        tuning['zram'] = min(memory / 2, zram_max)
+        sysctl['vm.swappiness'] = 100
+        sysctl['vm.page-cluster'] = 0
+        reasons.append('{0}M of zram swap, as the machine has {1}M of memory or less; '
+                       'swapping to it is cheap, so swappiness is raised and readahead '
+                       'disabled'.format(tuning['zram'] >> 20, zram_threshold >> 20))
+    else:
+        if memory:
+            reasons.append('No zram, as the machine has more than %dM of memory' % (
+                zram_threshold >> 20))
+        else:
+            reasons.append('No zram, as the memory could not be detected')
+        if profile == 'server':
+            sysctl['vm.swappiness'] = 10
+            reasons.append('Little swapping for a server')
+
+    if profile == 'server':
+        tuning['governor'] = 'performance'
+        reasons.append('CPU governor performance, as a server favours latency over power')
+    elif profile == 'laptop':
+        sysctl['vm.dirty_writeback_centisecs'] = 1500
+        reasons.append('Writeback every 15s on a laptop, so the disk can stay idle')
+    if profile == 'vm':
+        reasons.append('No CPU governor, frequency is up to the hypervisor')
+    elif not tuning['governor']:
+        reasons.append('Kernel default CPU governor, which scales with load')
+
+    reasons.append('I/O schedulers: none for NVMe and virtual disks, mq-deadline for '
+                   'other SSDs and bfq for rotational disks')
+
+    for key, value in sorted(parse_overrides(overrides).items()):
+        if key == 'governor':
+            tuning['governor'] = None if value == 'none' else value
+        elif key == 'zram':
+            tuning['zram'] = int(value) << 20
+        else:
+            sysctl[key] = value
+        reasons.append('%s set to %s by override' % (key, value))
+    return tuning
+
+
+def sysctl_conf(tuning):
+    return ''.join('%s = %s\n' % item for item in sorted(tuning['sysctl'].items()))
+
+
+def zram_conf(tuning):
+    # lz4 costs less CPU than zstd where there are few cores to spare
+    algorithm = 'zstd' if tuning['facts']['cpus'] >= 4 else 'lz4'
+    return '[zram0]\nzram-size = %d\ncompression-algorithm = %s\n' % (
+        tuning['zram'] >> 20, algorithm)
+
+
+def report(tuning):
+    return json.dumps(tuning, indent=1, sort_keys=True)